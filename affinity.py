@@ -4,6 +4,7 @@ affinity.py: Some basic routines for calculating initial affinities.
 
 import numpy as np
 import scipy.spatial as spsp
+import scipy.sparse as sps
 import warnings
 
 def _norm_ip_abs_aff(data):
@@ -97,7 +98,7 @@ def remove_mean(data):
     means = np.mean(data,axis=0)
     return data - means
 
-def gaussian_euclidean(data,knn=5,eps=1.0):
+def gaussian_euclidean(data,knn=5,eps=1.0,sparse_knn=None,chunk_size=4096):
     """
     data: mxn numpy array.
     
@@ -105,7 +106,12 @@ def gaussian_euclidean(data,knn=5,eps=1.0):
     Calculates affinity between columns of data as a Gaussian kernel of
     width eps*(median distance between 5 nearest neighbors of all points). 
     Returns nxn symmetric matrix of non-negative affinities.
+    If sparse_knn is given, only the sparse_knn nearest neighbors of each 
+    point are kept and a scipy.sparse csr matrix is returned instead; see
+    gaussian_knn.
     """
+    if sparse_knn is not None:
+        return gaussian_knn(data,sparse_knn,knn,eps,chunk_size)
     import sklearn.neighbors as sknn
 
     row_distances = spsp.distance.squareform(spsp.distance.pdist(data.T))
@@ -117,6 +123,42 @@ def gaussian_euclidean(data,knn=5,eps=1.0):
     medians = eps*np.median(dists,1)
     return np.exp(-(row_distances**2/(medians**2)))
 
+def gaussian_knn(data,n_neighbors=50,knn=5,eps=1.0,chunk_size=4096):
+    """
+    data: mxn numpy array.
+    
+    Sparse version of gaussian_euclidean: the affinity between columns i and 
+    j is exp(-d(i,j)**2/(s_i*s_j)), with s_i = eps*(median distance from i to
+    its knn nearest neighbors), kept only if j is one of the n_neighbors 
+    nearest neighbors of i or vice versa. 
+    Neighbors come from a KD/ball tree queried chunk_size points at a time,
+    so memory is O(n*n_neighbors).
+    Returns nxn symmetric scipy.sparse csr matrix of non-negative affinities.
+    """
+    import sklearn.neighbors as sknn
+
+    points = data.T
+    n = points.shape[0]
+    n_neighbors = min(max(n_neighbors,knn),n)
+    nn = sknn.NearestNeighbors(n_neighbors=n_neighbors)
+    nn.fit(points)
+    dists = np.zeros([n,n_neighbors])
+    cols = np.zeros([n,n_neighbors],np.int)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for start in xrange(0,n,chunk_size):
+            stop = min(start+chunk_size,n)
+            dists[start:stop],cols[start:stop] = nn.kneighbors(
+                                     points[start:stop],n_neighbors,True)
+    #neighbors come back sorted by distance, so these are the same medians
+    #gaussian_euclidean uses.
+    scales = eps*np.median(dists[:,:knn],1)
+    rows = np.repeat(np.arange(n),n_neighbors)
+    cols = cols.ravel()
+    values = np.exp(-(dists.ravel()**2/(scales[rows]*scales[cols])))
+    aff = sps.csr_matrix((values,(rows,cols)),shape=(n,n))
+    return aff.maximum(aff.T).tocsr()
+
 def threshold(affinity,threshold):
     """
     Takes an affinity and thresholds it by setting all entries to 0.0 which
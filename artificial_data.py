@@ -4,6 +4,7 @@ artificial_data.py: short implementation of a probability field of binary
 """
 
 import numpy as np
+import random_util
 
 class ProbabilityField(object):
     def __init__(self,means_matrix):
@@ -11,8 +12,13 @@ class ProbabilityField(object):
         assert np.sum(means_matrix < 0.0) == 0
         self.means = means_matrix
 
-    def realize(self):
-        r = np.random.rand(*self.means.shape)
+    def realize(self,seed=None):
+        """
+        Draws a +1/-1 matrix with P(+1) given by the means.
+        seed is an int, RandomState or Generator; None uses np.random.
+        """
+        r = random_util.rand(random_util.check_random_state(seed),
+                             *self.means.shape)
         data = -1*np.ones(self.means.shape)
         data += 2*(r < self.means)
         return data
\ No newline at end of file
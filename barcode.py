@@ -6,6 +6,8 @@ barcode.py: Functions for organizing and arranging data in tree and bi-tree
 
 import numpy as np
 import tree_util
+import dual_affinity
+import random_util
 
 def bifolder(row_folder,col_folder,data):
     """
@@ -126,6 +128,13 @@ def nn_param(data,start=0):
     return order
 
 def emd_nn(emd,start=0):
+    """
+    Orders points by walking from start to the nearest point not yet visited.
+    emd is an n x n EMD matrix or a dual_affinity.EMDIndex, whose exact 
+    nearest neighbor queries then replace sorting dense rows.
+    """
+    if isinstance(emd,dual_affinity.EMDIndex):
+        return _emd_nn_index(emd,start)
     n = emd.shape[0]
     order = []
     order.append(start)
@@ -136,12 +145,25 @@ def emd_nn(emd,start=0):
             order.append(nn[0])
     return order
 
-def organize_diffusion(data,row_vecs,col_vecs,nstarts=10):
+def _emd_nn_index(index,start=0):
+    visited = np.zeros(index.size,np.bool)
+    visited[start] = True
+    order = [start]
+    for _ in xrange(index.size-1):
+        nn,_ = index.nearest(order[-1],visited)
+        visited[nn] = True
+        order.append(nn)
+    return order
+
+def organize_diffusion(data,row_vecs,col_vecs,nstarts=10,seed=None):
     """
     Short algorithm to recover a permutation of shuffled data based on 
     the diffusion embeddings of rows and columns
+    seed (int, RandomState or Generator) picks the random starting points;
+    None uses np.random.
     """
-    starts = np.random.randint(0,min(data.shape),nstarts)    
+    starts = random_util.randint(random_util.check_random_state(seed),
+                                 0,min(data.shape),nstarts)
     l1_dist = np.zeros(len(starts))
     row_orders = {}
     col_orders = {}
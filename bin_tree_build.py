@@ -3,11 +3,15 @@ bin_tree_build.py: Functions for building trees based on cuts of the first
                    nontrivial eigenvector of a diffusion.
 """
 
+import multiprocessing.pool
 import tree
 import markov
+import random_util
 import numpy as np
+import scipy.sparse as sps
 
-def bin_tree_build(affinity,cut_type="r_dyadic",bal_constant=1.0):
+def bin_tree_build(affinity,cut_type="r_dyadic",bal_constant=1.0,n_jobs=1,
+                   seed=None):
     """
     Takes a static, square, symmetric nxn affinity on n nodes and 
     applies the second eigenvector binary cut algorithm to it.
@@ -15,33 +19,164 @@ def bin_tree_build(affinity,cut_type="r_dyadic",bal_constant=1.0):
     r_dyadic:   random dyadic; uniform distribution on the legal splits
                 based on the balance constant.
     zero:       splits the eigenvector at zero, subject to the balance constant 
+    The affinity can be dense or scipy.sparse, and is never written to (it 
+    can be a read-only memory map). The root's children get a permuted copy
+    of it, and from there each node's block is permuted in place so that 
+    its children are contiguous blocks, which are then cut without further
+    copies. Each child's 
+    eigenvector solve starts from its part of the parent's eigenvector.
+    n_jobs > 1 (experimental) cuts all the nodes of a level at once on that
+    many threads. Only the dense eigh of small nodes and the matrix 
+    products release the GIL; the eigsh iterations of large nodes run in 
+    Python and mostly serialize, and no speedup has been measured.
+    seed: if None, the random cuts are drawn from np.random, in the same 
+    order as a serial build. Otherwise (an int, RandomState or Generator; 
+    see random_util) each node draws from its own stream spawned from 
+    (seed, level, smallest element), so the tree only depends on seed and 
+    not on n_jobs or the order nodes are processed in.
     """
     
     _,n = affinity.shape
+    seed = random_util.seed_entropy(seed)
 
     root = tree.ClusterTreeNode(range(n))
     queue = [root]
+    blocks = {id(root):_AffinityBlock(affinity)}
 
-    while max([x.size for x in queue]) > 1:
-        new_queue = []
-        for node in queue:
-            if node.size > 2:
-                #cut it
-                if cut_type == "zero":
-                    cut = zero_eigen_cut(node,affinity)
-                elif cut_type == "r_dyadic":
-                    left,right = bal_cut(node.size,bal_constant)
-                    cut = random_dyadic_cut(node, affinity, left, right)
-                node.create_subclusters(cut)
+    pool = None
+    if n_jobs > 1:
+        pool = multiprocessing.pool.ThreadPool(n_jobs)
+    try:
+        while max([x.size for x in queue]) > 1:
+            #draw the random cuts up front, in order, then cut the whole 
+            #level (possibly in parallel).
+            jobs = []
+            for node in queue:
+                if node.size > 2:
+                    cut_loc = None
+                    if cut_type == "r_dyadic":
+                        left,right = bal_cut(node.size,bal_constant)
+                        cut_loc = random_util.randint(
+                            _node_random_state(node,seed),left,right+1)
+                    jobs.append((blocks.pop(id(node)),cut_type,cut_loc))
+            if pool is None:
+                cuts = map(_cut_block,jobs)
             else:
-                #make the singletons
-                node.create_subclusters(np.arange(node.size))
-            new_queue.extend(node.children)
-        queue = new_queue
+                cuts = pool.map(_cut_block,jobs)
+            cuts.reverse()
+            new_queue = []
+            for node in queue:
+                if node.size > 2:
+                    #cut it
+                    cut,child_blocks = cuts.pop()
+                    node.create_subclusters(cut)
+                    for (child,child_block) in zip(node.children,child_blocks):
+                        blocks[id(child)] = child_block
+                else:
+                    #make the singletons
+                    node.create_subclusters(np.arange(node.size))
+                new_queue.extend(node.children)
+            queue = new_queue
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     root.make_index()                
     return root    
 
+def _node_random_state(node,seed):
+    """
+    The random stream a node's cut is drawn from; see bin_tree_build.
+    """
+    return random_util.spawn_random_state(seed,node.level,node.elements[0])
+
+def _cut_block(job):
+    """
+    Cuts one node's _AffinityBlock. job is (block,cut_type,cut_loc).
+    Returns the labels (in node.elements order) and the children's blocks.
+    """
+    block,cut_type,cut_loc = job
+    eig = block.eigenvector()
+    if cut_type == "zero":
+        cut = eig < 0.0
+    elif cut_type == "r_dyadic":
+        cut = _dyadic_labels(eig,cut_loc)
+    return cut,block.split(cut)
+
+class _AffinityBlock(object):
+    """
+    The affinity restricted to one tree node, as rows/cols start:stop of a 
+    permuted working copy of the whole affinity. elements gives the original 
+    index of each row of the block; v0 is the warm start for the eigensolver.
+    The root block is the caller's affinity itself, which split copies 
+    rather than permutes.
+    elements is always sorted (the root's is arange and split sorts stably 
+    by label), so the rows of a block are in node.elements order.
+    """
+    def __init__(self,affinity,start=0,stop=None,elements=None,v0=None):
+        self.is_root = elements is None
+        if self.is_root:
+            if sps.issparse(affinity):
+                affinity = sps.csr_matrix(affinity,dtype=np.float)
+            else:
+                affinity = np.asarray(affinity,dtype=np.float)
+            stop = affinity.shape[0]
+            elements = np.arange(stop)
+        self.affinity = affinity
+        self.start = start
+        self.stop = stop
+        self.elements = elements
+        self.v0 = v0
+        
+    @property
+    def matrix(self):
+        return self.affinity[self.start:self.stop,self.start:self.stop]
+    
+    def eigenvector(self):
+        """
+        The first nontrivial eigenvector of the block, normalized as 
+        markov.markov_eigs does.
+        """
+        vecs,_ = markov.markov_eigs(self.matrix,2,False,v0=self.v0)
+        self.v0 = vecs[:,1]
+        eig = vecs[:,1]/vecs[:,0]
+        if eig[0] != 0.0:
+            eig *= np.sign(eig[0])
+        return eig
+        
+    def split(self,labels):
+        """
+        Permutes the block so that the elements with each label (in sorted
+        label order, as create_subclusters does) are contiguous, and returns
+        a block for each label.
+        """
+        block_labels = np.asarray(labels)
+        perm = np.argsort(block_labels,kind='mergesort')
+        if sps.issparse(self.affinity):
+            #csr slicing copies anyway, so the children just get their own.
+            sub = self.matrix[perm][:,perm].tocsr()
+            affinity,offset = sub,0
+        elif self.is_root:
+            affinity,offset = self.affinity[np.ix_(perm,perm)],0
+        else:
+            sub = self.matrix
+            sub[...] = sub[np.ix_(perm,perm)]
+            affinity,offset = self.affinity,self.start
+        elements = self.elements[perm]
+        v0 = self.v0[perm]
+        counts = np.unique(block_labels,return_counts=True)[1]
+        bounds = np.hstack([[0],np.cumsum(counts)])
+        return [_AffinityBlock(affinity,offset+a,offset+b,elements[a:b],v0[a:b])
+                for (a,b) in zip(bounds[:-1],bounds[1:])]
+
+def _dyadic_labels(eig,cut_loc):
+    """
+    Labels the cut_loc smallest entries of eig True.
+    """
+    eig_sorted = eig.argsort().argsort()
+    return eig_sorted < cut_loc
+
 def zero_eigen_cut(node,affinity):
     """
     Returns the cut of the affinity matrix (cutting at zero) 
@@ -54,20 +189,18 @@ def zero_eigen_cut(node,affinity):
     
     return labels
 
-def random_dyadic_cut(node,affinity,left,right):
+def random_dyadic_cut(node,affinity,left,right,random_state=None):
     """
     Returns a randomized cut of the affinity matrix (cutting at zero) 
     corresponding to the elements in node, under the condition of bal_constant.
+    random_state is a seed, RandomState or Generator (None: np.random).
     """ 
     new_data = affinity[node.elements,:][:,node.elements]
     
     vecs,_ = markov.markov_eigs(new_data, 2)
-    eig = vecs[:,1]
-    eig_sorted = eig.argsort().argsort()
-    cut_loc = np.random.randint(left,right+1)
-    labels = eig_sorted < cut_loc
-    
-    return labels
+    cut_loc = random_util.randint(random_util.check_random_state(random_state),
+                                  left,right+1)
+    return _dyadic_labels(vecs[:,1],cut_loc)
     
 def bal_cut(n,balance_constant):
     """
@@ -85,11 +218,13 @@ def bal_cut(n,balance_constant):
         left = right
     return left,right    
 
-def random_binary_tree(n,bal_constant):
+def random_binary_tree(n,bal_constant,seed=None):
     """
     Creates a random binary tree on n nodes that conforms to the balance
     constant.
+    seed is as in bin_tree_build.
     """
+    seed = random_util.seed_entropy(seed)
     root = tree.ClusterTreeNode(range(n))
     queue = [root]
     while queue:
@@ -98,9 +233,10 @@ def random_binary_tree(n,bal_constant):
             break
         node = queue.pop(0)
         left,right = bal_cut(node.size, bal_constant)
-        cut_loc = np.random.randint(left,right+1)
+        cut_loc = random_util.randint(_node_random_state(node,seed),
+                                      left,right+1)
         labels = np.array(node.elements).argsort().argsort() < cut_loc
         node.create_subclusters(labels)
         queue.extend(node.children)
     root.make_index()
-    return root
\ No newline at end of file
+    return root
@@ -0,0 +1,432 @@
+"""
+compact_tree.py: Array-backed tree with the same interface as
+                 tree.ClusterTreeNode, but O(n) memory.
+"""
+
+import numpy as np
+import tree
+
+class CompactTreeNode(object):
+    """
+    A lightweight view onto one folder of a CompactTree. Nothing is stored
+    here but the tree and the node index; everything else is looked up in
+    the arrays of the tree.
+    """
+    __slots__ = ("tree","idx")
+
+    def __init__(self,tree,idx):
+        self.tree = tree
+        self.idx = idx
+
+    def __eq__(self,other):
+        return (isinstance(other,CompactTreeNode) and
+                other.tree is self.tree and other.idx == self.idx)
+
+    def __ne__(self,other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.tree),self.idx))
+
+    def __repr__(self):
+        return "CompactTreeNode(idx={},level={},size={})".format(self.idx,
+                                                                  self.level,
+                                                                  self.size)
+
+    @property
+    def parent(self):
+        p = self.tree.parents[self.idx]
+        if p < 0:
+            return None
+        return self.tree[p]
+
+    @property
+    def children(self):
+        t = self.tree
+        cs = t.child_idx[t.child_start[self.idx]:t.child_start[self.idx+1]]
+        return [CompactTreeNode(t,x) for x in cs]
+
+    @property
+    def elements(self):
+        """
+        Returns the (sorted) list of elements in this folder.
+        """
+        return sorted(self.tree.order[self._slice].tolist())
+
+    @property
+    def _slice(self):
+        offset = self.tree.offsets[self.idx]
+        return slice(offset,offset+self.tree.sizes[self.idx])
+
+    @property
+    def size(self):
+        return int(self.tree.sizes[self.idx])
+
+    @property
+    def level(self):
+        return int(self.tree.levels[self.idx])
+
+    @property
+    def tree_size(self):
+        """
+        Returns the total size of the tree rooted at this node.
+        """
+        return int(self.tree.subtree_sizes[self.idx])
+
+    @property
+    def tree_depth(self):
+        """
+        Returns the depth in levels of the tree rooted at this node.
+        """
+        return int(self.tree.subtree_depths[self.idx])
+
+    def _subtree_mask(self):
+        t = self.tree
+        offset,size = t.offsets[self.idx],t.sizes[self.idx]
+        return ((t.levels >= t.levels[self.idx]) & (t.offsets >= offset) &
+                (t.offsets + t.sizes <= offset + size))
+
+    def traverse(self,floor_level=None):
+        """
+        Returns all nodes of the subtree rooted here in index order.
+        """
+        mask = self._subtree_mask()
+        if floor_level is not None:
+            mask &= self.tree.levels <= floor_level
+        return [self.tree[x] for x in np.flatnonzero(mask)]
+
+    def dfs_leaves(self):
+        """
+        Depth-first leaves search.
+        Returns all leaves of the subtree in depth-first search order.
+        """
+        mask = self._subtree_mask() & (self.tree.n_children == 0)
+        return self.tree._dfs_sorted(np.flatnonzero(mask))
+
+    def dfs_level(self,level=None):
+        """
+        Returns the set of all nodes at the level specified, in depth-first
+        order. Also accepts negative indices (so the bottom level is -1)
+        """
+        if level is None:
+            level = self.tree_depth
+        if level < 0:
+            level = self.tree_depth + level
+        mask = self._subtree_mask() & (self.tree.levels == level)
+        return self.tree._dfs_sorted(np.flatnonzero(mask))
+
+    def all_ancestors(self):
+        """
+        Returns a list of the indices of all the ancestors of a given node.
+        """
+        parents = []
+        p = self.tree.parents[self.idx]
+        while p >= 0:
+            parents.append(int(p))
+            p = self.tree.parents[p]
+        return parents
+
+    def all_descendants(self):
+        """
+        Returns a list of the indices of all the descendants of a given node.
+        """
+        return [x.idx for x in self.traverse()[1:]]
+
+
+class CompactTree(object):
+    """
+    A partition tree stored as flat arrays instead of node objects.
+    All arrays are indexed by node.idx, which is numbered exactly as
+    ClusterTreeNode.make_index does it (by level, then by smallest element):
+    parents:      idx of the parent (-1 for the root)
+    levels:       level of the node, starting at 1 for the root
+    sizes:        number of elements in the node
+    offsets:      start of the node's elements in order
+    child_start,
+    child_idx:    the children of node i are child_idx[child_start[i]:
+                  child_start[i+1]], in their original order.
+    order is a permutation of the elements (the depth-first leaf order), so
+    that the elements of node i are order[offsets[i]:offsets[i]+sizes[i]].
+    """
+    #per-tree derived data (eg tree_util.folder_indicator).
+    _cache = None
+
+    def __init__(self,order,parents,levels,offsets,sizes,child_start,
+                 child_idx):
+        self.order = np.asarray(order,np.int64)
+        self.parents = np.asarray(parents,np.int64)
+        self.levels = np.asarray(levels,np.int64)
+        self.offsets = np.asarray(offsets,np.int64)
+        self.sizes = np.asarray(sizes,np.int64)
+        self.child_start = np.asarray(child_start,np.int64)
+        self.child_idx = np.asarray(child_idx,np.int64)
+        self.n_children = np.diff(self.child_start)
+        self._calc_subtree_stats()
+
+    def _calc_subtree_stats(self):
+        """
+        Accumulates node counts and depths from the bottom up, a level at a
+        time.
+        """
+        n_nodes = len(self.parents)
+        self.subtree_sizes = np.ones(n_nodes,np.int64)
+        self.subtree_depths = np.ones(n_nodes,np.int64)
+        #node indices are sorted by level, so each level is a contiguous run.
+        bounds = np.searchsorted(self.levels,np.arange(1,self.levels.max()+2))
+        for level in xrange(self.levels.max(),1,-1):
+            nodes = np.arange(bounds[level-1],bounds[level])
+            np.add.at(self.subtree_sizes,self.parents[nodes],
+                      self.subtree_sizes[nodes])
+            np.maximum.at(self.subtree_depths,self.parents[nodes],
+                          self.subtree_depths[nodes]+1)
+
+    @classmethod
+    def from_leaf_order(cls,order,level_starts):
+        """
+        Builds a tree from a leaf ordering of the elements.
+        order is a permutation of range(n).
+        level_starts is a list, one entry per level below the root, of the
+        (increasing) positions in order at which the folders of that level
+        start. Each level has to refine the one above it.
+        """
+        order = np.asarray(order,np.int64)
+        n = len(order)
+        starts = [np.array([0],np.int64)]
+        for s in level_starts:
+            s = np.unique(np.asarray(s,np.int64))
+            if len(s) == 0 or s[0] != 0 or s[-1] >= n:
+                raise ValueError("Folder starts must begin at 0 and be < n.")
+            if not np.all(np.in1d(starts[-1],s)):
+                raise ValueError("Each level must refine the level above.")
+            starts.append(s)
+
+        level_sizes = [len(s) for s in starts]
+        level_base = np.cumsum([0]+level_sizes)
+        all_offsets = np.concatenate(starts)
+        all_sizes = np.concatenate([np.diff(np.append(s,n)) for s in starts])
+        all_levels = np.repeat(np.arange(1,len(starts)+1),level_sizes)
+
+        #rank nodes within each level by their smallest element.
+        mins = np.concatenate([np.minimum.reduceat(order,s) for s in starts])
+        dfs_pos = np.arange(len(all_offsets))
+        new_pos = np.lexsort((mins,all_levels))
+        new_idx = np.empty_like(new_pos)
+        new_idx[new_pos] = dfs_pos
+
+        #the parent of a folder is the folder above it with the last start
+        #position <= its own.
+        all_parents = np.empty(len(all_offsets),np.int64)
+        all_parents[0] = -1
+        for level in xrange(1,len(starts)):
+            local = np.searchsorted(starts[level-1],starts[level],'right') - 1
+            all_parents[level_base[level]:level_base[level+1]] = \
+                new_idx[level_base[level-1]+local]
+
+        parents = all_parents[new_pos]
+        levels = all_levels[new_pos]
+        offsets = all_offsets[new_pos]
+        sizes = all_sizes[new_pos]
+
+        #children: grouped by parent idx, and ordered by leaf position.
+        nonroot = np.flatnonzero(parents >= 0)
+        child_idx = nonroot[np.lexsort((offsets[nonroot],parents[nonroot]))]
+        counts = np.bincount(parents[nonroot],minlength=len(parents))
+        child_start = np.concatenate([[0],np.cumsum(counts)])
+        return cls(order,parents,levels,offsets,sizes,child_start,child_idx)
+
+    @classmethod
+    def from_cluster_tree(cls,t):
+        """
+        Converts an indexed ClusterTreeNode tree (from bin_tree_build,
+        flex_tree_build, question_tree.mtree, ...) into a CompactTree with the
+        same node indices and child order. Extra attributes hung on the nodes
+        (eg the linear models from mtree) are not carried over.
+        """
+        n_nodes = t.tree_size
+        parents = -np.ones(n_nodes,np.int64)
+        levels = np.zeros(n_nodes,np.int64)
+        offsets = np.zeros(n_nodes,np.int64)
+        sizes = np.zeros(n_nodes,np.int64)
+        child_start = np.zeros(n_nodes+1,np.int64)
+        child_idx = []
+        for node in t:
+            levels[node.idx] = node.level
+            sizes[node.idx] = node.size
+            child_start[node.idx+1] = len(node.children)
+            if node.parent is not None:
+                parents[node.idx] = node.parent.idx
+        child_start = np.cumsum(child_start)
+        for node in t:
+            child_idx.extend([x.idx for x in node.children])
+
+        #depth first walk to lay out the leaves.
+        order = []
+        stack = [t[0]]
+        while stack:
+            node = stack.pop()
+            offsets[node.idx] = len(order)
+            if len(node.children) == 0:
+                order.extend(node.elements)
+            else:
+                stack.extend(reversed(node.children))
+
+        ct = cls(order,parents,levels,offsets,sizes,child_start,child_idx)
+        if sorted(order) != range(t.size) or np.any(
+                np.bincount(ct.parents[1:],ct.sizes[1:],n_nodes)[
+                    ct.n_children > 0] != ct.sizes[ct.n_children > 0]):
+            raise ValueError("Tree folders are not a nested partition.")
+        return ct
+
+    def to_cluster_tree(self):
+        """
+        Converts back to an indexed ClusterTreeNode tree. Node indices and
+        child order are preserved.
+        """
+        nodes = [tree.ClusterTreeNode(self.order[self.offsets[i]:
+                                                 self.offsets[i]+
+                                                 self.sizes[i]].tolist())
+                 for i in xrange(self.tree_size)]
+        for i in xrange(self.tree_size):
+            node = nodes[i]
+            for c in self.child_idx[self.child_start[i]:self.child_start[i+1]]:
+                nodes[c].parent = node
+                node.children.append(nodes[c])
+        nodes[0].make_index()
+        return nodes[0]
+
+    def _dfs_sorted(self,idxs):
+        """
+        Returns the nodes in idxs sorted into depth-first order.
+        """
+        idxs = idxs[np.lexsort((self.levels[idxs],self.offsets[idxs]))]
+        return [self[x] for x in idxs]
+
+    def __getitem__(self,key):
+        """
+        Allows lookup of tree nodes by index, like row_tree[17].
+        """
+        if isinstance(key,slice):
+            return [self[x] for x in xrange(*key.indices(self.tree_size))]
+        if key < 0:
+            key += self.tree_size
+        if not 0 <= key < self.tree_size:
+            raise IndexError("node index out of range")
+        return CompactTreeNode(self,key)
+
+    def __iter__(self):
+        for x in xrange(self.tree_size):
+            yield CompactTreeNode(self,x)
+
+    def __len__(self):
+        return self.tree_size
+
+    @property
+    def tree_size(self):
+        return len(self.parents)
+
+    @property
+    def size(self):
+        return len(self.order)
+
+    @property
+    def tree_depth(self):
+        return int(self.subtree_depths[0])
+
+    @property
+    def idx(self):
+        return 0
+
+    @property
+    def level(self):
+        return 1
+
+    @property
+    def parent(self):
+        return None
+
+    @property
+    def children(self):
+        return self[0].children
+
+    @property
+    def elements(self):
+        return range(self.size)
+
+    def traverse(self,floor_level=None):
+        return self[0].traverse(floor_level)
+
+    def dfs_leaves(self):
+        """
+        Depth-first leaves search.
+        Returns all leaves in depth-first search order.
+        """
+        return self._dfs_sorted(np.flatnonzero(self.n_children == 0))
+
+    def dfs_level(self,level=None):
+        return self[0].dfs_level(level)
+
+    def leaves(self):
+        """
+        Returns the set of all leaves, in index order.
+        """
+        return [self[x] for x in np.flatnonzero(self.n_children == 0)]
+
+    def level_nodes(self,level=None):
+        """
+        Returns the set of all nodes at the level specified.
+        Also accepts negative indices (so the bottom level is -1)
+        """
+        if level is None:
+            level = self.tree_depth
+        if level < 0:
+            level = self.tree_depth + level
+        return [self[x] for x in np.flatnonzero(self.levels == level)]
+
+    def sublevel_elements(self,level):
+        """
+        Returns a list of lists of the elements in level
+        """
+        return [x.elements for x in self.level_nodes(level)]
+
+    def level_partition(self,level):
+        """
+        Returns the partition of the tree at the specified level as an array
+        with the index (within the level) of the folder containing each point.
+        """
+        partition = np.zeros(self.size,np.int64)
+        for (idx,x) in enumerate(np.flatnonzero(self.levels == level)):
+            partition[self.order[self.offsets[x]:
+                                 self.offsets[x]+self.sizes[x]]] = idx
+        return partition.tolist()
+
+    def _positions(self):
+        if not hasattr(self,"_inverse_order"):
+            self._inverse_order = np.empty_like(self.order)
+            self._inverse_order[self.order] = np.arange(self.size)
+        return self._inverse_order
+
+    def folder_set(self,element):
+        """
+        Returns the index set of all parents of element.
+        """
+        p = self._positions()[element]
+        mask = (self.offsets <= p) & (p < self.offsets + self.sizes)
+        return np.flatnonzero(mask).tolist()
+
+    def tree_distance(self,i,j):
+        """
+        Returns the tree distance between elements i and j: the size of the
+        smallest folder containing both, as a fraction of the whole tree.
+        """
+        if i==j:
+            return 0.0
+        pos = self._positions()
+        lo,hi = min(pos[i],pos[j]),max(pos[i],pos[j])
+        mask = (self.offsets <= lo) & (hi < self.offsets + self.sizes)
+        return 1.0*self.sizes[mask].min()/self.size
+
+    def copy(self):
+        return CompactTree(self.order.copy(),self.parents.copy(),
+                           self.levels.copy(),self.offsets.copy(),
+                           self.sizes.copy(),self.child_start.copy(),
+                           self.child_idx.copy())
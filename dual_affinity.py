@@ -6,14 +6,39 @@ dual_affinity.py: Functions for calculating dual affinity based on Earth
 import numpy as np
 import tree_util
 import scipy.spatial as spsp
+import scipy.sparse as sps
 import collections
+import multiprocessing.pool
+import threading
+import time
 
-def emd_dual_aff(emd,eps=1.0):
+DEFAULT_KNN = 10
+
+#EMDIndex: columns sampled to choose the bound level, cost of an exact 
+#candidate coordinate relative to a bound coordinate (candidates are 
+#gathered one query at a time), bound matrix entries computed at a time, 
+#and the relative slack of bound comparisons (bounds are rounded too).
+INDEX_SAMPLE_SIZE = 64
+INDEX_CANDIDATE_COST = 10.0
+INDEX_QUERY_BLOCK = 2**22
+BOUND_SLACK = 1.0 + 1e-9
+
+#tile size for blocked_cityblock: a 2048x2048 tile of float64 is 32MB.
+DEFAULT_BLOCK_SIZE = 2048
+
+def emd_dual_aff(emd,eps=1.0,knn=None):
     """
     Calculates the EMD affinity from a distance matrix
     by normalizing by the median EMD and taking exp^(-EMD)
     without thresholding.
+    emd can also be an EMDIndex, in which case only the knn (default 
+    DEFAULT_KNN) nearest neighbors of each point are kept, the median is 
+    estimated from a sample, and the result is a symmetric scipy.sparse csr
+    matrix. This needs O(n) memory instead of O(n**2), but saves little 
+    time below roughly 10000 points.
     """
+    if isinstance(emd,EMDIndex):
+        return emd.dual_aff(knn or DEFAULT_KNN,eps)
    
     epall = eps*np.median(emd)
     if epall == 0.0:
@@ -21,15 +46,317 @@ def emd_dual_aff(emd,eps=1.0):
     
     return np.exp(-emd/epall)
 
-def calc_emd(data,row_tree,alpha=1.0,beta=0.0,exc_sing=False):
+def calc_emd(data,row_tree,alpha=1.0,beta=0.0,exc_sing=False,
+             block_size=None,n_jobs=1,out=None,progress=None):
     """
     Calculates the EMD on the *columns* from data and a tree on the rows.
     each level is weighted by 2**((1-level)*alpha)
     each folder size (fraction) is raised to the beta power for weighting.
+    If any of block_size, n_jobs > 1, out or progress is given, the 
+    distances are computed by blocked_cityblock (see there) instead of one 
+    pdist, so only the result itself needs to fit in memory (or on disk, 
+    with out a np.memmap or file name).
+    """
+    ext_vecs,_ = _weighted_averages(data,row_tree,alpha,beta,exc_sing)
+    
+    if (block_size is not None or n_jobs > 1 or out is not None or 
+        progress is not None):
+        return blocked_cityblock(ext_vecs.T,block_size or DEFAULT_BLOCK_SIZE,
+                                 n_jobs,out,progress)
+    pds = spsp.distance.pdist(ext_vecs.T,"cityblock")
+    distances = spsp.distance.squareform(pds)
+
+    return distances
+
+def calc_emd_mean(data,row_trees,alpha=1.0,beta=0.0,exc_sing=False,
+                  block_size=None,n_jobs=1):
+    """
+    The average of calc_emd(data,row_tree,...) over the trees in row_trees,
+    eg an ensemble of random trees (spin-cycling). Each EMD is an L1 
+    distance between embeddings, so the average is one L1 distance between
+    the concatenated embeddings, divided by the number of trees.
+    block_size and n_jobs are as for calc_emd.
+    """
+    vecs = np.hstack([emd_embedding(data,x,alpha,beta,exc_sing) 
+                      for x in row_trees])
+    if block_size is not None or n_jobs > 1:
+        distances = blocked_cityblock(vecs,block_size or DEFAULT_BLOCK_SIZE,
+                                      n_jobs,None,None)
+    else:
+        distances = spsp.distance.squareform(
+            spsp.distance.pdist(vecs,"cityblock"))
+    distances /= len(row_trees)
+    return distances
+
+def emd_embedding(data,row_tree,alpha=1.0,beta=0.0,exc_sing=False):
+    """
+    Returns the weighted folder averages of the columns of data (one row per
+    column) whose pairwise L1 distances are calc_emd(data,row_tree,...).
+    """
+    ext_vecs,_ = _weighted_averages(data,row_tree,alpha,beta,exc_sing)
+    return np.ascontiguousarray(ext_vecs.T)
+
+class EMDIndex(object):
+    """
+    Exact nearest neighbor index for the EMD between the columns of data.
+    The EMD is the L1 distance between emd_embedding vectors, whose 
+    coordinates are the folders of row_tree level by level. Keeping the 
+    folders down to bound_level, with those on bound_level scaled by
+    _bound_multipliers, gives a shorter vector whose L1 distances are lower
+    bounds of the EMD. A query computes these bounds to all columns, takes 
+    the EMD to the columns with the 2k smallest bounds to get an upper 
+    bound t for its k-th neighbor, and ranks only the columns whose bound 
+    is at most t by their exact EMD. Results are exactly those of calc_emd.
+    bound_level defaults to the level minimizing the estimated query cost
+    (bound length plus INDEX_CANDIDATE_COST times the candidate length), 
+    from a sample of the columns. Queries still look at every column, but 
+    only at the coarse coordinates of most of them.
+    Queries take new columns (with the same rows, embedded by the same 
+    tree), or None for the indexed columns themselves; a column is its own
+    nearest neighbor then.
+    """
+    def __init__(self,data,row_tree,alpha=1.0,beta=0.0,exc_sing=False,
+                 bound_level=None,seed=0):
+        self.row_tree = row_tree
+        self.alpha = alpha
+        self.beta = beta
+        self.exc_sing = exc_sing
+        self.vecs = emd_embedding(data,row_tree,alpha,beta,exc_sing)
+        self._multipliers = _bound_multipliers(row_tree,alpha,beta,exc_sing)
+        self._levels = np.array([node.level for node in row_tree])
+        random_state = np.random.RandomState(seed)
+        sample = random_state.choice(self.size,
+                                     min(self.size,INDEX_SAMPLE_SIZE),
+                                     replace=False)
+        emds = np.sort(spsp.distance.cdist(self.vecs[sample],self.vecs,
+                                           "cityblock"),axis=1)
+        self._median = np.median(emds[:,1:]) if self.size > 1 else 0.0
+        if bound_level is None:
+            near = emds[:,min(DEFAULT_KNN,self.size-1)]
+            costs = []
+            for level in xrange(1,np.max(self._levels)+1):
+                bounds = spsp.distance.cdist(
+                    self._bound_vecs(self.vecs[sample],level),
+                    self._bound_vecs(self.vecs,level),"cityblock")
+                candidates = np.mean(bounds <= near[:,np.newaxis])
+                costs.append(np.sum(self._levels <= level) + 
+                             INDEX_CANDIDATE_COST*candidates*self.vecs.shape[1])
+            bound_level = 1 + int(np.argmin(costs))
+        self.bound_level = bound_level
+        self.bound_vecs = self._bound_vecs(self.vecs,bound_level)
+    
+    @property
+    def size(self):
+        return self.vecs.shape[0]
+    
+    def _bound_vecs(self,vecs,level):
+        """
+        The coordinates of vecs down to level, the last level scaled by the
+        multipliers.
+        """
+        length = np.sum(self._levels <= level)
+        scale = np.where(self._levels[:length] == level,
+                         self._multipliers[:length],1.0)
+        return vecs[:,:length]*scale
+    
+    def _query_vecs(self,data):
+        if data is None:
+            return self.vecs,self.bound_vecs
+        vecs = emd_embedding(data,self.row_tree,self.alpha,self.beta,
+                             self.exc_sing)
+        return vecs,self._bound_vecs(vecs,self.bound_level)
+    
+    def _bounds(self,bound_vecs):
+        """
+        Yields (query,bounds) for each of bound_vecs: its lower bounds of 
+        the EMD to all indexed columns.
+        """
+        chunk = max(1,INDEX_QUERY_BLOCK//self.size)
+        for start in xrange(0,len(bound_vecs),chunk):
+            bounds = spsp.distance.cdist(bound_vecs[start:start+chunk],
+                                         self.bound_vecs,"cityblock")
+            for i in xrange(len(bounds)):
+                yield start+i,bounds[i]
+    
+    def _search(self,vec,bounds,k):
+        """
+        The k nearest indexed columns to vec and their EMDs, closest first,
+        given the lower bounds of its EMD to them (np.inf to skip a column).
+        """
+        near = np.argpartition(bounds,min(2*k,self.size)-1)[:2*k]
+        near = near[np.isfinite(bounds[near])]
+        emds = spsp.distance.cdist(vec[np.newaxis],self.vecs[near],
+                                   "cityblock")[0]
+        if len(near) > k:
+            t = np.partition(emds,k-1)[k-1]
+            candidates = np.flatnonzero(bounds <= t*BOUND_SLACK)
+            emds = spsp.distance.cdist(vec[np.newaxis],self.vecs[candidates],
+                                       "cityblock")[0]
+        else:
+            candidates = near
+        nearest = np.argsort(emds,kind="mergesort")[:k]
+        return candidates[nearest],emds[nearest]
+    
+    def knn(self,k,data=None):
+        """
+        The k nearest indexed columns to each column of data.
+        Returns (indices,emds), each cols x k, closest first.
+        """
+        vecs,bound_vecs = self._query_vecs(data)
+        k = min(k,self.size)
+        indices = np.zeros([len(vecs),k],np.int64)
+        emds = np.zeros([len(vecs),k])
+        for i,bounds in self._bounds(bound_vecs):
+            indices[i],emds[i] = self._search(vecs[i],bounds,k)
+        return indices,emds
+    
+    def radius(self,r,data=None):
+        """
+        The indexed columns within EMD r of each column of data.
+        Returns (indices,emds): lists of arrays, one per column, closest first.
+        """
+        vecs,bound_vecs = self._query_vecs(data)
+        indices = []
+        emds = []
+        for i,bounds in self._bounds(bound_vecs):
+            candidates = np.flatnonzero(bounds <= r*BOUND_SLACK)
+            dists = spsp.distance.cdist(vecs[i:i+1],self.vecs[candidates],
+                                        "cityblock")[0]
+            inside = np.flatnonzero(dists <= r)
+            inside = inside[np.argsort(dists[inside],kind="mergesort")]
+            indices.append(candidates[inside])
+            emds.append(dists[inside])
+        return indices,emds
+    
+    def nearest(self,col,exclude=None):
+        """
+        The indexed column nearest to indexed column col, skipping those 
+        where the boolean array exclude is True, and its EMD.
+        """
+        bounds = spsp.distance.cdist(self.bound_vecs[col:col+1],
+                                     self.bound_vecs,"cityblock")[0]
+        if exclude is not None:
+            bounds[exclude] = np.inf
+        indices,emds = self._search(self.vecs[col],bounds,1)
+        return indices[0],emds[0]
+    
+    def median_emd(self):
+        """
+        Estimate of the median EMD between indexed columns, from a sample.
+        """
+        return self._median
+    
+    def dual_aff(self,knn=DEFAULT_KNN,eps=1.0):
+        """
+        Sparse version of emd_dual_aff: exp(-EMD/(eps*median EMD)) between 
+        each column and its knn nearest neighbors, symmetrized (an edge is 
+        kept if either end has the other among its neighbors).
+        """
+        indices,emds = self.knn(knn+1)
+        epall = eps*self.median_emd()
+        if epall == 0.0:
+            epall = 1.0
+        rows = np.repeat(np.arange(self.size),indices.shape[1])
+        aff = sps.csr_matrix((np.exp(-emds.ravel()/epall),
+                              (rows,indices.ravel())),
+                             shape=(self.size,self.size))
+        return aff.maximum(aff.T).tocsr()
+
+def _bound_multipliers(row_tree,alpha,beta,exc_sing):
+    """
+    For each folder f of row_tree (by node.idx), a factor m such that the 
+    EMD terms of f and the folders below it add up to at least m times the
+    term of f. The children of a folder split it, so its average is theirs 
+    weighted by size, and the children's terms add up to at least rho times
+    its own, rho the smallest of weight(child)*size(f)/(size(child)*
+    weight(f)). Going down the levels, m sums these bounds.
+    """
+    weights = _folder_weights(row_tree,alpha,beta,exc_sing)
+    nodes = list(row_tree)
+    #factors[f][j]: the terms j levels below f add up to at least this 
+    #times the term of f.
+    factors = [None]*len(nodes)
+    for node in reversed(nodes):
+        if not node.children:
+            factors[node.idx] = [1.0]
+            continue
+        if weights[node.idx] == 0.0:
+            rho = 0.0
+        else:
+            rho = min([weights[x.idx]*node.size/(x.size*weights[node.idx]) 
+                       for x in node.children])
+        depth = min([len(factors[x.idx]) for x in node.children])
+        factors[node.idx] = [1.0] + [rho*min([factors[x.idx][j] 
+                                              for x in node.children])
+                                     for j in xrange(depth)]
+    return np.array([sum(x) for x in factors])
+
+def blocked_cityblock(vecs,block_size=DEFAULT_BLOCK_SIZE,n_jobs=1,out=None,
+                      progress=None):
+    """
+    Returns the n x n matrix of L1 distances between the n rows of vecs.
+    It is filled in block_size x block_size tiles (each computed once and 
+    mirrored), by n_jobs threads. 
+    out is where to put the result: an n x n array (eg a np.memmap), the 
+    file name of a float64 np.memmap to create, or None for a new array. 
+    progress, if given, is called after each tile as 
+    progress(tiles_done,n_tiles,seconds_elapsed,seconds_remaining_estimate).
+    """
+    vecs = np.ascontiguousarray(vecs,dtype=np.float)
+    n = vecs.shape[0]
+    if out is None:
+        out = np.zeros([n,n])
+    elif isinstance(out,basestring):
+        out = np.memmap(out,dtype=np.float,mode="w+",shape=(n,n))
+    starts = range(0,n,block_size)
+    tiles = [(a,b) for (i,a) in enumerate(starts) for b in starts[i:]]
+    start_time = time.time()
+    lock = threading.Lock()
+    done = [0]
+    def tile(job):
+        a,b = job
+        dists = spsp.distance.cdist(vecs[a:a+block_size],vecs[b:b+block_size],
+                                    "cityblock")
+        out[a:a+block_size,b:b+block_size] = dists
+        if a != b:
+            out[b:b+block_size,a:a+block_size] = dists.T
+        if progress is not None:
+            with lock:
+                done[0] += 1
+                elapsed = time.time() - start_time
+                progress(done[0],len(tiles),elapsed,
+                         elapsed*(len(tiles)-done[0])/done[0])
+    if n_jobs > 1:
+        pool = multiprocessing.pool.ThreadPool(n_jobs)
+        try:
+            pool.map(tile,tiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        map(tile,tiles)
+    if isinstance(out,np.memmap):
+        out.flush()
+    return out
+
+def _weighted_averages(data,row_tree,alpha,beta,exc_sing):
+    """
+    The folder averages of the columns of data, weighted as in calc_emd, and
+    the weights.
     """
     rows,_ = np.shape(data)
     assert rows == row_tree.size, "Tree size must match # rows in data."
 
+    folder_fraction = _folder_weights(row_tree,alpha,beta,exc_sing)
+    coefs = tree_util.tree_averages(data,row_tree)
+    
+    return folder_fraction[:,np.newaxis]*coefs,folder_fraction
+
+def _folder_weights(row_tree,alpha,beta,exc_sing):
+    """
+    The calc_emd weight of each folder of row_tree, by node.idx.
+    """
+    rows = row_tree.size
     folder_fraction = np.array([((node.size*1.0/rows)**beta)*
                                 (2.0**((1.0-node.level)*alpha))
                                  for node in row_tree])
@@ -37,48 +364,159 @@ def calc_emd(data,row_tree,alpha=1.0,beta=0.0,exc_sing=False):
         for node in row_tree:
             if node.size == 1:
                 folder_fraction[node.idx] = 0.0
-    coefs = tree_util.tree_averages(data,row_tree)
+    return folder_fraction
     
-    ext_vecs = np.diag(folder_fraction).dot(coefs)
+class IncrementalEMD(object):
+    """
+    Keeps calc_emd(data,row_tree,alpha,beta,exc_sing) up to date as row_tree
+    changes, eg from one questionnaire iteration to the next.
+    The EMD is a sum over folders of |weight*(average of column i on the 
+    folder - average of column j)|, so each folder's part only depends on 
+    its elements and weight. update() compares the folders of the new tree
+    to the last one, and only adds in the parts of new folders and takes out 
+    those of folders that are gone. If more than max_changed of the folders 
+    changed, it recomputes from scratch instead.
+    """
+    def __init__(self,data,alpha=1.0,beta=0.0,exc_sing=False,max_changed=0.5):
+        self.data = data
+        self.alpha = alpha
+        self.beta = beta
+        self.exc_sing = exc_sing
+        self.max_changed = max_changed
+        self.folders = {}
+        self.condensed = None
     
-    pds = spsp.distance.pdist(ext_vecs.T,"cityblock")
-    distances = spsp.distance.squareform(pds)
-
-    return distances
+    def update(self,row_tree):
+        """
+        Returns calc_emd(data,row_tree,...) for the new row_tree.
+        """
+        rows,_ = np.shape(self.data)
+        assert rows == row_tree.size, "Tree size must match # rows in data."
+        weights = _folder_weights(row_tree,self.alpha,self.beta,self.exc_sing)
+        keys = [(tuple(node.elements),weights[node.idx]) for node in row_tree]
+        counts = collections.defaultdict(int)
+        for (key,weight) in zip(keys,weights):
+            if weight != 0.0:
+                counts[key] += 1
+        changes = dict((x,counts.get(x,0) - self.folders.get(x,(None,0))[1]) 
+                       for x in set(counts) | set(self.folders))
+        changes = dict((x,y) for (x,y) in changes.iteritems() if y != 0)
+        if (self.condensed is None or 
+            len(changes) > self.max_changed*max(len(counts),1)):
+            #same computation as calc_emd.
+            ext_vecs,_ = _weighted_averages(self.data,row_tree,self.alpha,
+                                            self.beta,self.exc_sing)
+            self.folders = {}
+            for (idx,key) in enumerate(keys):
+                if key in counts:
+                    self.folders[key] = (ext_vecs[idx],counts[key])
+            self.condensed = spsp.distance.pdist(ext_vecs.T,"cityblock")
+            return spsp.distance.squareform(self.condensed)
+        new_keys = [x for x in changes if x not in self.folders]
+        if new_keys:
+            idxs = dict((x,i) for (i,x) in enumerate(keys))
+            new_idxs = [idxs[x] for x in new_keys]
+            indicator = tree_util.folder_indicator(row_tree)[new_idxs]
+            sizes = tree_util.node_sizes(row_tree)[new_idxs]
+            new_rows = ((weights[new_idxs]/sizes)[:,np.newaxis]*
+                        indicator.dot(self.data))
+            for (x,row) in zip(new_keys,new_rows):
+                self.folders[x] = (row,0)
+        for sign in [1,-1]:
+            changed = [x for x in changes if changes[x]*sign > 0]
+            if changed:
+                weighted = np.array([self.folders[x][0]*abs(changes[x]) 
+                                     for x in changed])
+                self.condensed += sign*spsp.distance.pdist(weighted.T,
+                                                           "cityblock")
+        #rounding in the subtractions can leave tiny negatives.
+        np.maximum(self.condensed,0.0,out=self.condensed)
+        for (x,change) in changes.iteritems():
+            row,count = self.folders[x]
+            if count + change == 0:
+                del self.folders[x]
+            else:
+                self.folders[x] = (row,count + change)
+        return spsp.distance.squareform(self.condensed)
     
 def calc_emd_ref(ref_data,data,row_tree,alpha=1.0,beta=0.0):
     """
     Calculates the EMD from a set of points to a reference set of points
     The columns of ref_data are each a reference set point.
     The columns of data are each a point outside the reference set.
+    Returns a ref_cols x cols matrix; see ReferenceEMD to score many batches
+    against the same reference set.
     """
-    ref_rows,ref_cols = np.shape(ref_data)
-    rows,cols = np.shape(data)
-    assert rows == row_tree.size, "Tree size must match # rows in data."
-    assert ref_rows == rows, "Mismatched row #: reference and sample sets."
+    return ReferenceEMD(ref_data,row_tree,alpha,beta).distances(data)
 
-    emd = np.zeros([ref_cols,cols])
-    ref_coefs = tree_util.tree_averages(ref_data, row_tree)
-    coefs = tree_util.tree_averages(data, row_tree)
-    level_elements = collections.defaultdict(list)
-    level_sizes = collections.defaultdict(int)
-    
-    for node in row_tree:
-        level_elements[node.level].append(node.idx)
-        level_sizes[node.level] += node.size
+class ReferenceEMD(object):
+    """
+    The EMD of calc_emd_ref from new points to a fixed reference set.
+    Each folder's average is weighted by (its share of its level)**beta 
+    times the level weight 2**((1-level)*alpha), which makes the EMD a 
+    single L1 distance between weighted average vectors. The reference 
+    vectors are computed once; queries go through chunk_size columns at a 
+    time, so memory is bounded by ref_cols x chunk_size.
+    """
+    def __init__(self,ref_data,row_tree,alpha=1.0,beta=0.0,chunk_size=1024):
+        ref_rows,_ = np.shape(ref_data)
+        assert ref_rows == row_tree.size, "Tree size must match # rows in data."
+        self.row_tree = row_tree
+        self.chunk_size = chunk_size
+        levels = np.array([node.level for node in row_tree])
+        sizes = tree_util.node_sizes(row_tree).astype(np.float)
+        level_sizes = np.bincount(levels,weights=sizes)
+        self.weights = ((sizes/level_sizes[levels])**beta*
+                        2.0**((1.0-levels)*alpha))
+        self.ref_vecs = self._vecs(ref_data)
         
-    folder_fraction = np.array([node.size for node in row_tree],np.float)
-    for level in xrange(1,row_tree.tree_depth+1):
-        fsize = np.sum(folder_fraction[level_elements[level]])
-        folder_fraction[level_elements[level]] /= fsize
-    
-    folder_fraction = folder_fraction**beta
-    coefs = np.diag(folder_fraction).dot(coefs)
-    ref_coefs = np.diag(folder_fraction).dot(ref_coefs)
-    for level in xrange(1,row_tree.tree_depth+1):
-        distances = spsp.distance.cdist(coefs[level_elements[level],:].T,
-                                        ref_coefs[level_elements[level],:].T,
-                                        "cityblock").T
-        emd += (2**((1.0-level)*alpha))*distances
-
-    return emd
\ No newline at end of file
+    def _vecs(self,data):
+        """
+        Weighted folder averages of the columns of data, one row per column.
+        """
+        rows,_ = np.shape(data)
+        assert rows == self.row_tree.size, "Mismatched row #: reference and sample sets."
+        coefs = tree_util.tree_averages(data,self.row_tree)
+        return np.ascontiguousarray((self.weights[:,np.newaxis]*coefs).T)
+    
+    def iter_distances(self,data):
+        """
+        Yields (start,block) for consecutive chunks of the columns of data, 
+        where block is the ref_cols x chunk EMD to columns start onwards.
+        """
+        _,cols = np.shape(data)
+        for start in xrange(0,cols,self.chunk_size):
+            vecs = self._vecs(data[:,start:start+self.chunk_size])
+            yield start,spsp.distance.cdist(self.ref_vecs,vecs,"cityblock")
+    
+    def distances(self,data):
+        """
+        The ref_cols x cols EMD from the reference set to the columns of data.
+        """
+        emd = np.zeros([self.ref_vecs.shape[0],np.shape(data)[1]])
+        for (start,block) in self.iter_distances(data):
+            emd[:,start:start+block.shape[1]] = block
+        return emd
+    
+    def nearest(self,data,k=1):
+        """
+        The k nearest reference points to each column of data.
+        Returns two cols x k arrays: the reference indices, and their EMDs, 
+        closest first.
+        """
+        _,cols = np.shape(data)
+        k = min(k,self.ref_vecs.shape[0])
+        indices = np.zeros([cols,k],np.int)
+        dists = np.zeros([cols,k])
+        for (start,block) in self.iter_distances(data):
+            block = block.T
+            if k < block.shape[1]:
+                top = np.argpartition(block,k-1,axis=1)[:,:k]
+            else:
+                top = np.tile(np.arange(k),(block.shape[0],1))
+            top_dists = block[np.arange(block.shape[0])[:,np.newaxis],top]
+            order = np.argsort(top_dists,axis=1,kind='mergesort')
+            rows = np.arange(block.shape[0])[:,np.newaxis]
+            indices[start:start+block.shape[0]] = top[rows,order]
+            dists[start:start+block.shape[0]] = top_dists[rows,order]
+        return indices,dists
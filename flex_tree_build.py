@@ -2,10 +2,17 @@
 flex_tree_build.py: Functions for building flexible trees based on affinities
                     between points.
 """
+import heapq
 import numpy as np
 import markov
 import tree
 import scipy.spatial as spsp
+import scipy.sparse as sps
+
+#flex_tree_diffusion(cluster_distance="rms") compares all pairs of clusters 
+#up to this many, and only nearby ones past it.
+FLEX_DENSE_MAX_CLUSTERS = 4096
+MEDIAN_SAMPLE_SIZE = 100000
 
 class Cluster(object):
     """
@@ -32,29 +39,63 @@ class Clustering(object):
     So there are n nodes, which could be clusters at the lower level, and
     the Clustering object contains up to n Clusters that give the 
     hierarchical partition for the level.
+    Membership is kept in a union-find forest over the n nodes (union by 
+    size, path halving), so find and join_clusters are nearly constant time.
+    The Clusters themselves sit in n slots; a join keeps the merged cluster 
+    in the slot of n1's cluster and empties the other, and clusters lists 
+    them in slot order.
     """
     def __init__(self,n):
         self.n = n
-        self.cluster_lookup = {}
-        for i in xrange(n):
-            self.cluster_lookup[i] = i
+        self._parent = range(n)
+        self._slot = range(n)
         self._clusters = []
         for i in xrange(n):
             self._clusters.append(Cluster([i]))
+        self._n_clusters = n
     
     def __len__(self):
-        return len([x for x in self._clusters if x.size > 0])
+        return self._n_clusters
+    
+    def _root(self,idx):
+        parent = self._parent
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
     
     def join_clusters(self,n1,n2):
-        c1 = self._clusters[self.cluster_lookup[n1]]
-        c2 = self._clusters[self.cluster_lookup[n2]]
-        for x in c2.elements:
-            self.cluster_lookup[x] = n1
-        c1.elements = c1.elements.union(c2.elements)
-        c2.elements = set([])
+        r1 = self._root(n1)
+        r2 = self._root(n2)
+        if r1 == r2:
+            return
+        s1 = self._slot[r1]
+        s2 = self._slot[r2]
+        c1 = self._clusters[s1]
+        c2 = self._clusters[s2]
+        #move the smaller set into the larger one, then put the result in 
+        #slot s1.
+        if c1.size < c2.size:
+            c2.elements.update(c1.elements)
+            c1.elements = set([])
+            self._clusters[s1],self._clusters[s2] = c2,c1
+            self._parent[r1] = r2
+            self._slot[r2] = s1
+        else:
+            c1.elements.update(c2.elements)
+            c2.elements = set([])
+            self._parent[r2] = r1
+        self._n_clusters -= 1
         
     def find(self,idx):
-        return self._clusters[self.cluster_lookup[idx]]
+        return self._clusters[self._slot[self._root(idx)]]
+    
+    @property
+    def cluster_lookup(self):
+        """
+        Dict of node -> slot of its cluster.
+        """
+        return dict((i,self._slot[self._root(i)]) for i in xrange(self.n))
     
     def test_join(self,edge_wt,e1,e2,penalty):
         c1 = self.find(e1)
@@ -87,14 +128,20 @@ class ClusteringPartition(Clustering):
     def __init__(self,partition):
         """
         takes a list of lists and makes those the clusters.
+        The elements must be 0..n-1 for n elements in all.
         """
         self.n = sum([len(x) for x in partition])
         self._clusters = []
-        self.cluster_lookup = {}
+        self._parent = range(self.n)
+        self._slot = range(self.n)
         for (idx,cluster) in enumerate(partition):
             self._clusters.append(Cluster(cluster))
+            cluster = list(cluster)
             for element in cluster:
-                self.cluster_lookup[element] = idx
+                self._parent[element] = cluster[0]
+            if cluster:
+                self._slot[cluster[0]] = idx
+        self._n_clusters = len([x for x in self._clusters if x.size > 0])
 
 def cluster_transform(diffusion,clustering):
     Q = np.zeros([len(clustering),diffusion.shape[0]],np.float)
@@ -134,63 +181,190 @@ def clusterlist_to_tree(cluster_list):
         root.make_index()
         return root
 
-def cluster_from_affinity(affinity,eps=1.0,threshold=1e-8):
-    #print "eps: {}".format(eps)
-    A = affinity.copy()
-    A -= np.diag(np.diag(A))
-    
-    Alocs = np.argmax(A,axis=1)  #stores the location of the max entry in this row
-    Amaxes = A[range(A.shape[0]),Alocs] #stores the max entry in this row
+class _RowCandidates(object):
+    """
+    For each row of a matrix, the columns in order of preference (largest
+    values first, or smallest if smallest is True; ties by column index), 
+    which is the order repeated np.argmax/np.argmin calls would visit them 
+    in if each visited entry were then knocked out with the value filler. 
+    A row is only sorted the first time its second choice is asked for.
+    Dense rows are read from the matrix; for a csr matrix only the stored 
+    entries are candidates.
+    """
+    def __init__(self,matrix,smallest=False,filler=0.0):
+        self.matrix = matrix
+        self.sign = 1.0 if smallest else -1.0
+        self.filler = filler
+        self.sparse = sps.issparse(matrix)
+        self.orders = {}
+        if self.sparse:
+            n = matrix.shape[0]
+            self.first = np.zeros(n,np.int)
+            self.first_values = np.zeros(n) + filler
+            for row in xrange(n):
+                cols,vals = self._row(row)
+                if len(cols) > 0:
+                    best = np.argmin(self.sign*vals)
+                    self.first[row] = cols[best]
+                    self.first_values[row] = vals[best]
+        elif smallest:
+            self.first = np.argmin(matrix,axis=1)
+            self.first_values = matrix[np.arange(matrix.shape[0]),self.first]
+        else:
+            self.first = np.argmax(matrix,axis=1)
+            self.first_values = matrix[np.arange(matrix.shape[0]),self.first]
+        
+    def _row(self,row):
+        if self.sparse:
+            a,b = self.matrix.indptr[row],self.matrix.indptr[row+1]
+            return self.matrix.indices[a:b],self.matrix.data[a:b]
+        return np.arange(self.matrix.shape[1]),self.matrix[row]
     
-    penalty = np.median(A[A>threshold])*eps
-    #print "penalty: {}".format(penalty)
-    clustering = Clustering(affinity.shape[0])
+    def next(self,row):
+        """
+        Returns the next (column,value) for row, or (row,filler) when the
+        row has run out.
+        """
+        if row not in self.orders:
+            cols,vals = self._row(row)
+            order = np.lexsort((cols,self.sign*vals))
+            self.orders[row] = [cols[order],vals[order],0]
+        cols,vals,pos = self.orders[row]
+        pos += 1
+        self.orders[row][2] = pos
+        if pos >= len(cols):
+            return row,self.filler
+        return cols[pos],vals[pos]
+
+def _off_diagonal(matrix):
+    """
+    Copy of sparse matrix as a csr matrix with sorted indices and the stored
+    diagonal entries removed (stored zeros off the diagonal are kept).
+    """
+    coo = sps.coo_matrix(matrix,dtype=np.float)
+    keep = coo.row != coo.col
+    return sps.csr_matrix((coo.data[keep],(coo.row[keep],coo.col[keep])),
+                          shape=coo.shape)
+
+def _merge_loop(candidates,values,locs,stop,try_join,dead_value,largest):
+    """
+    The nearest neighbor merge loop shared by cluster_from_affinity and 
+    cluster_from_distance. values/locs hold each row's current best entry;
+    rows are visited best first (smallest row index on ties, like argmax) 
+    from a heap with lazy deletion. The loop stops at the first row with 
+    stop(value) True once something has been joined. A row joined to 
+    another is retired along with its partner (value set to dead_value); a
+    rejected pair moves the row on to its next candidate.
+    """
+    sign = -1.0 if largest else 1.0
+    stamps = [0]*len(values)
+    heap = [(sign*v,row,0) for (row,v) in enumerate(values)]
+    heapq.heapify(heap)
+    def update(row,value):
+        values[row] = value
+        stamps[row] += 1
+        heapq.heappush(heap,(sign*value,row,stamps[row]))
     joins = 0
-    while 1:
-        row = np.argmax(Amaxes)
-        col = Alocs[row]
-        #print "row: {} col: {}".format(row,col)
-        if Amaxes[row] <= penalty and joins > 0:
+    while heap:
+        _,row,stamp = heapq.heappop(heap)
+        if stamp != stamps[row]:
+            continue
+        col = locs[row]
+        if stop(values[row]) and joins > 0:
             break
-        if clustering.test_join(A[row,col],row,col,penalty):
-            Amaxes[row] = 0.0
-            Amaxes[col] = 0.0
+        if try_join(values[row],row,col):
+            update(row,dead_value)
+            update(col,dead_value)
             joins += 1
         else:
-            A[row,col] = 0.0
-            Alocs[row] = np.argmax(A[row,:])
-            Amaxes[row] = A[row,Alocs[row]]        
-    return clustering
+            locs[row],value = candidates.next(row)
+            update(row,value)
 
-def cluster_from_distance(distance_matrix,eps=1.0):
+def cluster_from_affinity(affinity,eps=1.0,threshold=1e-8):
+    """
+    Clusters the nodes of a (dense or sparse) affinity by repeatedly taking
+    the node with the strongest remaining edge and joining it to that 
+    neighbor's cluster if Clustering.test_join allows it. 
+    """
     #print "eps: {}".format(eps)
-    A = distance_matrix.copy()
-    A += 999.0*np.eye(A.shape[0])
+    if sps.issparse(affinity):
+        A = _off_diagonal(affinity)
+        entries = A.data
+    else:
+        A = np.array(affinity,dtype=np.float)
+        np.fill_diagonal(A,0.0)
+        entries = A
+    candidates = _RowCandidates(A,smallest=False,filler=0.0)
     
-    Alocs = np.argmin(A,axis=1)  #stores the location of the min dist in row
-    Amins = A[range(A.shape[0]),Alocs] #stores the min entry in this row
+    penalty = np.median(entries[entries>threshold])*eps
+    #print "penalty: {}".format(penalty)
+    clustering = Clustering(affinity.shape[0])
+    def try_join(value,row,col):
+        return clustering.test_join(value,row,col,penalty)
+    _merge_loop(candidates,list(candidates.first_values),
+                list(candidates.first),lambda x: x <= penalty,try_join,0.0,
+                True)
+    return clustering
+
+def cluster_from_distance(distance_matrix,eps=1.0,median=None):
+    """
+    Clusters the nodes of a (dense or sparse) distance matrix by repeatedly
+    taking the node with the shortest remaining edge and joining it to that
+    neighbor's cluster if Clustering.test_join_distance allows it. 
+    For a sparse matrix, missing entries count as far apart and the median 
+    is over the stored entries.
+    median, if given, is used in place of the median of the matrix (eg an 
+    estimate of the median of the full matrix a sparse one was cut from).
+    """
+    #print "eps: {}".format(eps)
+    if sps.issparse(distance_matrix):
+        A = _off_diagonal(distance_matrix)
+        med = np.median(A.data)
+    else:
+        A = np.array(distance_matrix,dtype=np.float)
+        A[np.diag_indices_from(A)] += 999.0
+        med = np.median(A)
+    if median is not None:
+        med = median
+    candidates = _RowCandidates(A,smallest=True,filler=999.0)
     
-    med = np.median(A)
-    penalty = np.median(A)/eps
+    penalty = med/eps
     #print "penalty: {}".format(penalty)
     clustering = Clustering(A.shape[0])
-    joins = 0
-    while 1:
-        row = np.argmin(Amins)
-        col = Alocs[row]
-        #print "row: {} col: {} dist: {}".format(row,col,Amins[row])
-        if Amins[row] >= med and joins > 0:
-            break
-        if clustering.test_join_distance(A[row,col],row,col,penalty):
-            Amins[row] = 999.0
-            Amins[col] = 999.0
-            joins += 1
-        else:
-            A[row,col] = 999.0
-            Alocs[row] = np.argmin(A[row,:])
-            Amins[row] = A[row,Alocs[row]]        
+    def try_join(value,row,col):
+        return clustering.test_join_distance(value,row,col,penalty)
+    _merge_loop(candidates,list(candidates.first_values),
+                list(candidates.first),lambda x: x >= med,try_join,999.0,
+                False)
     return clustering
 
+def _coarsen(clustering,partition):
+    """
+    partition lists the (sorted) original elements of each current node, and
+    clustering clusters those nodes. Returns the sparse k_new x k membership
+    matrix of nodes in clusters and the partition of the original elements 
+    into the new clusters (in the order of clustering.clusters, which is the 
+    order clusterlist_to_tree puts them in).
+    """
+    clusters = [sorted(x.elements) for x in clustering.clusters]
+    rows = np.repeat(np.arange(len(clusters)),[len(x) for x in clusters])
+    cols = np.concatenate(clusters)
+    membership = sps.csr_matrix((np.ones(len(cols)),(rows,cols)),
+                                shape=(len(clusters),len(partition)))
+    new_partition = [np.sort(np.concatenate([partition[x] for x in cluster]))
+                     for cluster in clusters]
+    return membership,new_partition
+
+def _averaging_matrix(partition,n):
+    """
+    Sparse row stochastic matrix averaging over each set in partition.
+    """
+    sizes = np.array([len(x) for x in partition])
+    rows = np.repeat(np.arange(len(partition)),sizes)
+    cols = np.concatenate(partition)
+    return sps.csr_matrix((1.0/sizes[rows],(rows,cols)),
+                          shape=(len(partition),n))
+
 def flex_tree(affinity,penalty_constant,threshold=1e-8):
     """
     Takes affinity, a square matrix of positive entries representing an 
@@ -199,57 +373,138 @@ def flex_tree(affinity,penalty_constant,threshold=1e-8):
     at all levels and doesn't compute a diffusion. All it does is join things
     based on their closeness (higher affinity). Cluster affinity to each other
     is the average affinity between elements.
+    The summed affinity between clusters is coarsened from the level below
+    through a sparse membership matrix, so each level after the first costs
+    O(k^2) for k clusters. A sparse affinity stays sparse throughout.
     """ 
     #print "***starting***"
-    q = np.eye(affinity.shape[0]) #initialize q for code brevity.
+    if sps.issparse(affinity):
+        sums = sps.csr_matrix(affinity,dtype=np.float)
+    else:
+        sums = np.asarray(affinity,dtype=np.float)
+    sizes = np.ones(affinity.shape[0])
+    partition = [np.array([x]) for x in xrange(affinity.shape[0])]
     cluster_list = []
     i=0
     while 1:
         #print "clustering at level {}".format(i)
         i+=1 
-        new_affinity = q.dot(affinity).dot(q.T)
+        if i == 1:
+            new_affinity = sums
+        elif sps.issparse(sums):
+            scale = sps.diags(1.0/sizes)
+            new_affinity = scale.dot(sums).dot(scale).tocsr()
+        else:
+            new_affinity = sums/np.outer(sizes,sizes)
         cluster_list.append(cluster_from_affinity(new_affinity,
                                                   penalty_constant,
                                                   threshold))
         #print "clusters: {}".format(len(cluster_list[-1]))
         if len(cluster_list[-1]) == 1:
             break
-        temp_tree = clusterlist_to_tree(cluster_list)
-        cpart = ClusteringPartition([x.elements for x in temp_tree.dfs_level(2)])
-        q,_ = cluster_transform_matrices(cpart)
+        membership,partition = _coarsen(cluster_list[-1],partition)
+        if sps.issparse(sums):
+            sums = membership.dot(sums).dot(membership.T).tocsr()
+        else:
+            sums = membership.dot(membership.dot(sums).T).T
+        sizes = membership.dot(sizes)
     return clusterlist_to_tree(cluster_list)    
 
-def flex_tree_diffusion(affinity,penalty_constant,n_eigs=12):
+def _rms_cluster_distances(points,partition,n_neighbors=10):
     """
-    affinity is an nxn affinity matrix.
+    Root mean square distance between the points of each pair of sets in 
+    partition, which is exactly sqrt(|m_c - m_d|^2 + v_c + v_d) for the means
+    m and mean squared distances to the mean v of the sets.
+    Returns the k x k distance matrix and None for k sets, up to 
+    FLEX_DENSE_MAX_CLUSTERS. Past that, returns a sparse matrix with each
+    set's n_neighbors nearest sets by mean (from a KD-tree) and an estimate 
+    of the median of the full matrix from random pairs.
+    """
+    n = points.shape[0]
+    k = len(partition)
+    if k == n:
+        means = points[np.concatenate(partition)]
+        variances = np.zeros(k)
+    else:
+        q = _averaging_matrix(partition,n)
+        means = q.dot(points)
+        variances = np.maximum(q.dot(np.sum(points**2,axis=1)) - 
+                               np.sum(means**2,axis=1),0.0)
+    if k <= FLEX_DENSE_MAX_CLUSTERS:
+        sq_dists = (spsp.distance.cdist(means,means,'sqeuclidean') + 
+                    variances[:,np.newaxis] + variances[np.newaxis,:])
+        return np.sqrt(sq_dists),None
+    def rms(rows,cols):
+        return np.sqrt(np.sum((means[rows]-means[cols])**2,axis=1) + 
+                       variances[rows] + variances[cols])
+    _,neighbors = spsp.cKDTree(means).query(means,min(n_neighbors+1,k))
+    rows = np.repeat(np.arange(k),neighbors.shape[1])
+    cols = neighbors.ravel()
+    rows,cols = np.hstack([rows,cols]),np.hstack([cols,rows])
+    pairs = np.unique(rows[rows != cols]*k + cols[rows != cols])
+    #pairs are sorted by row then column, so they are already csr order.
+    rows,cols = pairs // k,pairs % k
+    dists = sps.csr_matrix((rms(rows,cols),cols,
+                            np.searchsorted(rows,np.arange(k+1))),shape=(k,k))
+    random_state = np.random.RandomState(0)
+    sample_rows = random_state.randint(k,size=MEDIAN_SAMPLE_SIZE)
+    sample_cols = random_state.randint(k-1,size=MEDIAN_SAMPLE_SIZE)
+    sample_cols += sample_cols >= sample_rows
+    return dists,np.median(rms(sample_rows,sample_cols))
+
+def flex_tree_diffusion(affinity,penalty_constant,n_eigs=12,
+                        cluster_distance="average",n_neighbors=10):
+    """
+    affinity is an nxn affinity matrix (dense or scipy.sparse).
     Creates a flexible tree by calculating the diffusion on the given affinity.
     Then clusters at each level by the flexible tree algorithm. For each level
     up, doubles the diffusion time.
     penalty_constant is the multiplier of the median diffusion distance.
+    cluster_distance is how far apart two clusters are:
+    average:    the average diffusion distance between their points. Needs
+                all n^2 distances at every level.
+    rms:        the root mean square diffusion distance between their points,
+                computed from each cluster's mean and spread in the embedding.
+                Memory is k^2 for k clusters, and once k is past 
+                FLEX_DENSE_MAX_CLUSTERS only the n_neighbors nearest clusters
+                are compared (see _rms_cluster_distances), so it scales to 
+                large n with a sparse affinity.
     """
+    if cluster_distance not in ["average","rms"]:
+        raise ValueError("cluster_distance must be 'average' or 'rms'")
     #First, we calculate the first n eigenvectors and eigenvalues of the 
     #diffusion
     cluster_list = []
     vecs,vals = markov.markov_eigs(affinity,n_eigs)
     diff_time = 1.0
-    q = np.eye(affinity.shape[0])
+    n = affinity.shape[0]
+    partition = [np.array([x]) for x in xrange(n)]
     while 1:
         #now we calculate the diffusion distances between points at the 
         #current diffusion time.
         diff_vecs = vecs.dot(np.diag(vals**diff_time)) 
-        diff_dists = spsp.distance.squareform(spsp.distance.pdist(diff_vecs))
-        #we take the affinity between clusters to be the average diffusion 
-        #distance between them.
-        avg_dists = q.dot(diff_dists).dot(q.T)
+        median = None
+        if cluster_distance == "rms":
+            avg_dists,median = _rms_cluster_distances(diff_vecs,partition,
+                                                      n_neighbors)
+        else:
+            diff_dists = spsp.distance.squareform(spsp.distance.pdist(diff_vecs))
+            #we take the affinity between clusters to be the average diffusion
+            #distance between them. the distances change with the diffusion 
+            #time, so this has to go back to the points every level.
+            if len(partition) == n:
+                avg_dists = diff_dists
+            else:
+                q = _averaging_matrix(partition,n)
+                avg_dists = q.dot(q.dot(diff_dists).T).T
         #now we cluster the points based on this distance
-        cluster_list.append(cluster_from_distance(avg_dists,penalty_constant))
+        cluster_list.append(cluster_from_distance(avg_dists,penalty_constant,
+                                                  median))
         #if there is only one node left, then we are done.
         #otherwise, add another level to the tree, double the diffusion time
         #and keep going.
         if len(cluster_list[-1]) == 1:
             break
-        temp_tree = clusterlist_to_tree(cluster_list)
-        cpart = ClusteringPartition([x.elements for x in temp_tree.dfs_level(2)])
-        q,_ = cluster_transform_matrices(cpart)
+        _,partition = _coarsen(cluster_list[-1],partition)
         diff_time *= 2.0
-    return clusterlist_to_tree(cluster_list)
\ No newline at end of file
+    return clusterlist_to_tree(cluster_list)
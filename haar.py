@@ -3,7 +3,53 @@ haar.py: Functions for describing Haar, Haarlike, and tensor Haar bases on
          discrete spaces and products of discrete spaces.
 """ 
 
+import collections
 import numpy as np
+import tree_util
+
+#Haar plans and dense bases are kept in an LRU cache keyed by the tree 
+#fingerprint, so repeated transforms on the same tree (SURE sweeps, forward
+#then inverse, re-running notebook cells) don't rebuild them. 
+HAAR_CACHE_MAX_BYTES = 512*2**20
+_haar_cache = collections.OrderedDict()
+_haar_cache_bytes = [0]
+
+def clear_haar_cache(t=None):
+    """
+    Drops everything cached for tree t, or the whole cache if t is None.
+    """
+    if t is None:
+        keys = list(_haar_cache.keys())
+    else:
+        fingerprint = tree_util.tree_fingerprint(t)
+        keys = [x for x in _haar_cache if x[0] == fingerprint]
+    for key in keys:
+        _haar_cache_bytes[0] -= _haar_cache.pop(key)[1]
+
+def _cached(t,kind,build):
+    """
+    Returns the cached value (kind,...) for tree t, calling build() to make
+    it on a miss. Evicts the least recently used entries to stay under
+    HAAR_CACHE_MAX_BYTES; values larger than that are not cached at all.
+    """
+    key = (tree_util.tree_fingerprint(t),)+kind
+    if key in _haar_cache:
+        value,nbytes = _haar_cache.pop(key)
+        _haar_cache[key] = (value,nbytes)
+        return value
+    value = build()
+    if isinstance(value,dict):
+        nbytes = sum([x.nbytes for x in value.values() 
+                      if isinstance(x,np.ndarray)])
+    else:
+        nbytes = value.nbytes
+    if nbytes <= HAAR_CACHE_MAX_BYTES:
+        while _haar_cache and (_haar_cache_bytes[0] + nbytes > 
+                               HAAR_CACHE_MAX_BYTES):
+            _haar_cache_bytes[0] -= _haar_cache.popitem(last=False)[1][1]
+        _haar_cache[key] = (value,nbytes)
+        _haar_cache_bytes[0] += nbytes
+    return value
 
 def haar_vectors(n,node_sizes,norm="L2"):
     """
@@ -37,63 +83,184 @@ def haar_vectors(n,node_sizes,norm="L2"):
        
     return haar_basis
 
+def _haar_plan(t):
+    """
+    Returns the (cached) basis layout of t; see _build_haar_plan.
+    """
+    return _cached(t,("plan",),lambda: _build_haar_plan(t))
+
+def _build_haar_plan(t):
+    """
+    Lays out the Haar-like basis of t without building it. The children of 
+    each internal node (in node.idx order) are put in one array, largest 
+    first, exactly as compute_haar orders them; basis vector i of a node with
+    children c_0,...,c_k-1 is +minuses on c_i-1 and -pluses on c_i,...,c_k-1
+    (before normalization), where pluses = |c_i-1| and minuses = |c_i|+...
+    Returns a dict with, per basis vector after the constant one, the 
+    position of c_i-1 ("prev"), of c_i ("first") and one past the last child
+    ("end") in the child array, and the values of pluses and minuses; and per
+    entry of the child array, the position of its first sibling.
+    """
+    child_order = []
+    prev_pos = []
+    ends = []
+    group_starts = []
+    node_ids = [-1]
+    for node in t:
+        if len(node.children) > 0:
+            schildren = list(reversed(sorted(node.children,
+                                             key=lambda x:x.size)))
+            start = len(child_order)
+            k = len(schildren)
+            child_order.extend([x.idx for x in schildren])
+            group_starts.extend([start]*k)
+            prev_pos.extend(range(start,start+k-1))
+            ends.extend([start+k]*(k-1))
+            node_ids.extend([node.idx]*(k-1))
+    child_order = np.array(child_order,np.int64)
+    prev_pos = np.array(prev_pos,np.int64)
+    ends = np.array(ends,np.int64)
+    sizes = np.array([x.size for x in t],np.float64)[child_order]
+    size_sums = np.concatenate([[0.0],np.cumsum(sizes)])
+    pluses = sizes[prev_pos]
+    minuses = size_sums[ends] - size_sums[prev_pos+1]
+    return {"child_order":child_order,"prev":prev_pos,"first":prev_pos+1,
+            "end":ends,"group_starts":np.array(group_starts,np.int64),
+            "pluses":pluses,"minuses":minuses,
+            "node_ids":np.array(node_ids,np.int64),"n":t.size}
+
+def _haar_weights(plan,norm,inverse=False):
+    """
+    Returns the constant vector's value and, per basis vector, the values it
+    takes on c_i-1 and (negated) on c_i,...,c_k-1.
+    Forward weights are the normalized compute_haar vectors. Inverse "L1" 
+    weights are the same vectors scaled to unit L1 norm, which is what
+    inverse_haar_transform has always used.
+    """
+    pluses,minuses = plan["pluses"],plan["minuses"]
+    if norm == "L2":
+        norms = np.sqrt(minuses**2*pluses + pluses**2*minuses)
+        const = 1.0/np.sqrt(plan["n"])
+    elif norm == "L1" and not inverse:
+        norms = 2.0*(minuses*pluses)/(minuses+pluses)
+        const = 1.0
+    elif norm == "L1":
+        norms = 2.0*minuses*pluses
+        const = 1.0/plan["n"]
+    else:
+        raise ValueError("norm must be 'L1' or 'L2'")
+    return const,minuses/norms,pluses/norms
+
+def _cumsums(values):
+    return np.concatenate([np.zeros((1,)+values.shape[1:]),
+                           np.cumsum(values,axis=0)])
+
+def _group_suffix(values,starts,ends):
+    """
+    Returns the sums of values[start:end] for each (start,end) pair.
+    """
+    cumsums = _cumsums(values)
+    return cumsums[ends] - cumsums[starts]
+
+def _haar_analysis(data,t,plan,const,a,b):
+    """
+    Computes coefficients against the basis given by plan and weights, from
+    the folder sums of data.
+    """
+    n_rows = data.shape[0]
+    flat = data.reshape(n_rows,-1)
+    child_sums = tree_util.tree_sums(flat,t)[plan["child_order"]]
+    coefs = np.zeros((n_rows,flat.shape[1]))
+    coefs[0,:] = const*np.sum(flat,axis=0)
+    n_vecs = len(plan["prev"])
+    coefs[1:n_vecs+1,:] = (a[:,np.newaxis]*child_sums[plan["prev"]] - 
+                           b[:,np.newaxis]*_group_suffix(child_sums,
+                                                         plan["first"],
+                                                         plan["end"]))
+    return coefs.reshape(data.shape)
+
+def _haar_synthesis(coefs,t,plan,const,a,b):
+    """
+    Computes sum_i coefs[i]*(basis vector i) for the basis given by plan and
+    weights, by summing the values each basis vector takes on every child 
+    folder and then pushing the folder values down to the elements.
+    """
+    n_rows = coefs.shape[0]
+    flat = coefs.reshape(n_rows,-1)
+    n_vecs = len(plan["prev"])
+    vec_coefs = flat[1:n_vecs+1,:]
+    child_vals = np.zeros((len(plan["child_order"]),flat.shape[1]))
+    child_vals[plan["prev"],:] += a[:,np.newaxis]*vec_coefs
+    #vector i's -b runs from its first child to the end of the group, so 
+    #each child gets -b of every vector whose first child is at or before it.
+    steps = np.zeros(child_vals.shape)
+    steps[plan["first"],:] = b[:,np.newaxis]*vec_coefs
+    positions = np.arange(len(child_vals))
+    child_vals -= _group_suffix(steps,plan["group_starts"],positions+1)
+    folder_vals = np.zeros((t.tree_size,flat.shape[1]))
+    folder_vals[plan["child_order"],:] = child_vals
+    matrix = tree_util.inverse_tree_transform(folder_vals,t)
+    matrix += const*flat[0,:]
+    return matrix.reshape((t.size,)+coefs.shape[1:])
+
+def _node_ids(plan):
+    """
+    Returns the parent node.idx of each basis vector, padded with 0 for 
+    trees with fewer basis vectors than elements (as compute_haar does).
+    """
+    node_ids = np.zeros(plan["n"],np.int64)
+    node_ids[:len(plan["node_ids"])] = plan["node_ids"]
+    return node_ids
+
 def compute_haar(t,return_nodes=False,norm="L2"):
     """
     Takes a full tree of type ClusterTreeNode and computes the canonical 
     Haar-like basis.
     return_nodes specifies whether we want to return parent node.idx associated
     with each basis vector. (-1 means this is the root ie constant vector)
+    This is an n x n dense matrix; haar_transform and friends don't need it.
+    The basis is cached (see HAAR_CACHE_MAX_BYTES) and returned read-only.
     """
-    
-    n = t.size
-    haar_basis = np.zeros([n,n])
-    node_ids = np.zeros(n,np.int)
-    node_ids[0] = -1
-    cur_col = 1
-    haar_basis[:,0] = 1.0
-    if norm == "L2":
-        haar_basis[:,0] /= np.sqrt(n)
-    
-    for node in t:
-        node_size = len(node.children)
-        schildren = list(reversed(sorted(node.children,key=lambda x:x.size)))
-        if node_size > 0:
-            basis_vecs = haar_vectors(node_size,
-                                      np.array([x.size for x in schildren]),
-                                      norm)
-            
-            for i in xrange(1,node_size):
-                #each basis vector will be a column of the basis
-                for j,child in enumerate(schildren):
-                    haar_basis[child.elements,cur_col] = basis_vecs[j,i]
-                    node_ids[cur_col] = node.idx
-                cur_col += 1
-            
+    plan = _haar_plan(t)
+    def build():
+        const,a,b = _haar_weights(plan,norm)
+        basis = _haar_synthesis(np.eye(t.size),t,plan,const,a,b)
+        basis.flags.writeable = False
+        return basis
+    haar_basis = _cached(t,("basis",norm),build)
 
     if return_nodes:
-        return haar_basis, node_ids
+        return haar_basis, _node_ids(plan)
     else:
         return haar_basis
     
-def haar_transform(data,row_tree,norm="L2"):
+def haar_transform(data,row_tree,norm="L2",return_nodes=False):
     """
-    Computes the Haar transform of data with respect to row_tree. (nothing
-    fancy here, can go faster).
+    Computes the Haar transform of data with respect to row_tree, ie
+    compute_haar(row_tree,False,norm).T.dot(data), without building the 
+    basis: each coefficient is a weighted difference of sums over sibling 
+    folders, so the cost is that of the folder sums.
+    return_nodes also returns the node.idx of each coefficient as in
+    compute_haar.
     """
-    basis = compute_haar(row_tree,False,norm)
-    return basis.T.dot(data)
+    plan = _haar_plan(row_tree)
+    const,a,b = _haar_weights(plan,norm)
+    coefs = _haar_analysis(np.asarray(data,np.float64),row_tree,plan,
+                           const,a,b)
+    if return_nodes:
+        return coefs,_node_ids(plan)
+    return coefs
     
 def inverse_haar_transform(coefs,row_tree,norm="L2"):
     """
     Computes the inverse Haar transform of coefficients with respect to 
-    row_tree. Again nothing fancy here.
-    """
-    basis = compute_haar(row_tree)
-    if norm == "L1":
-        norm_vec = np.sum(np.abs(basis),axis=0)
-        for col in xrange(basis.shape[1]):
-            basis[:,col] /= norm_vec[col]
-    return basis.dot(coefs)
+    row_tree, without building the basis. For L1, the basis vectors are 
+    scaled to unit L1 norm.
+    """
+    plan = _haar_plan(row_tree)
+    const,a,b = _haar_weights(plan,norm,inverse=True)
+    return _haar_synthesis(np.asarray(coefs,np.float64),row_tree,plan,
+                           const,a,b)
     
 def level_correspondence(row_tree):
     """
@@ -116,19 +283,15 @@ def bihaar_transform(data,row_tree,col_tree,folder_sizes=False):
     Computes the bi-Haar transform into the basis induced by row_tree and 
     col_tree jointly.
     """
+    row_transform,row_parents = haar_transform(data,row_tree,
+                                               return_nodes=True)
+    coefs,col_parents = haar_transform(row_transform.T,col_tree,
+                                       return_nodes=True)
     if folder_sizes:
-        row_hb, row_parents = compute_haar(row_tree,folder_sizes)
         row_parents[row_parents == -1] = 0
-        col_hb, col_parents = compute_haar(col_tree,folder_sizes)
         col_parents[col_parents == -1] = 0
-    else:
-        row_hb = compute_haar(row_tree,folder_sizes)
-        col_hb = compute_haar(col_tree,folder_sizes)
-    row_transform = row_hb.T.dot(data)
-    coefs = col_hb.T.dot(row_transform.T)
-    if folder_sizes:
-        row_sizes = np.array([row_tree[x].size for x in row_parents])
-        col_sizes = np.array([col_tree[x].size for x in col_parents])
+        row_sizes = tree_util.node_sizes(row_tree)[row_parents]
+        col_sizes = tree_util.node_sizes(col_tree)[col_parents]
         return coefs.T, np.outer(row_sizes,
                                  col_sizes)/(1.0*row_tree.size*col_tree.size)
     else:
@@ -138,11 +301,6 @@ def inverse_bihaar_transform(coefs,row_tree,col_tree):
     """
     Computes the inverse bi-Haar transform of coefs. 
     """
-    row_hb = compute_haar(row_tree)
-    col_hb = compute_haar(col_tree)
-    row_transform = row_hb.dot(coefs)
-    matrix = col_hb.dot(row_transform.T)
+    row_transform = inverse_haar_transform(coefs,row_tree)
+    matrix = inverse_haar_transform(row_transform.T,col_tree)
     return matrix.T
-    
-    
-    
\ No newline at end of file
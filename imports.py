@@ -18,12 +18,14 @@ import affinity
 import artificial_data
 import barcode
 import bin_tree_build
+import compact_tree
 import dual_affinity
 import flex_tree_build
 import haar
 import markov
 import question_tree
 import questionnaire
+import random_util
 import tree
 import tree_recon
 import tree_util
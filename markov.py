@@ -4,55 +4,142 @@ markov.py: Function to calculate vectors and eigenvalues of Markov chain
 """
 
 import numpy as np
+import scipy.sparse as sps
 import scipy.sparse.linalg as spsl
 
+#below this size (or when most of the spectrum is wanted) a full dense eigh is
+#cheaper than ARPACK.
+DENSE_EIGH_MAX_N = 128
+
 def make_markov_symmetric(data,thres=1e-8):
     """
     data is a (symmetric) affinity matrix. elements less than thres are zeroed.
-    Returns a "symmetrized" and normalized version of the Markov chain matrix. 
-    """    
-    d_mat = data*(data > thres)
-    rowsums = np.sum(d_mat,axis=1) + 1e-15
-    p_mat = d_mat/(np.outer(rowsums,rowsums))
-    d_mat2 = np.sqrt(np.sum(p_mat,axis=1)) + 1e-15
-    p_mat = p_mat/(np.outer(d_mat2,d_mat2))
-    return p_mat
+    Returns a "symmetrized" and normalized version of the Markov chain matrix.
+    Sparse input gives a sparse csr result. Works on a single copy of data,
+    scaled in place.
+    """
+    return _markov_symmetric(data,thres)[0]
+
+def _markov_symmetric(data,thres):
+    """
+    make_markov_symmetric, also returning the top eigenvector of the result
+    (eigenvalue 1), which falls out of the normalization.
+    """
+    d_mat = _threshold_copy(data,thres)
+    rowsums = _rowsums(d_mat) + 1e-15
+    #p = d/outer(rowsums,rowsums) has row sums q = (d.dot(1/rowsums))/rowsums,
+    #and the result is p/outer(d2,d2) with d2 = sqrt(q). It is similar to the
+    #row stochastic p/q, so d2 is its eigenvector for eigenvalue 1.
+    d_mat2 = np.sqrt(_rowsums(d_mat,1.0/rowsums)/rowsums) + 1e-15
+    _scale(d_mat,1.0/(rowsums*d_mat2),both=True)
+    return d_mat,d_mat2
 
 def make_markov_row_stoch(data,thres=1e-8):
     """
     data is a (symmetric) affinity matrix. elements less than thres are zeroed.
-    Returns the row stochastic Markov matrix. 
-    """    
-    d_mat = data*(data > thres)
-    rowsums = 1.0/(np.sum(d_mat,axis=1) + 1e-15)
-    p_mat = np.diag(rowsums).dot(d_mat)
-    return p_mat
+    Returns the row stochastic Markov matrix.
+    Sparse input gives a sparse csr result.
+    """
+    d_mat = _threshold_copy(data,thres)
+    _scale(d_mat,1.0/(_rowsums(d_mat) + 1e-15))
+    return d_mat
 
-def markov_eigs(data,n_eigs,normalize=True,thres=1e-8):
+def _threshold_copy(data,thres):
+    """
+    Returns data*(data > thres) as a new float array (csr matrix if data is
+    sparse).
+    """
+    if sps.issparse(data):
+        d_mat = sps.csr_matrix(data,dtype=np.float,copy=True)
+        d_mat.data[d_mat.data <= thres] = 0.0
+        d_mat.eliminate_zeros()
+    else:
+        d_mat = np.array(data,dtype=np.float)
+        d_mat[d_mat <= thres] = 0.0
+    return d_mat
+
+def _rowsums(d_mat,weights=None):
+    """
+    Row sums of d_mat (weighted by weights on the columns) as a flat array.
     """
-    data is a (symmetric) affinity matrix.
+    if weights is None:
+        return np.asarray(d_mat.sum(axis=1)).ravel()
+    return np.asarray(d_mat.dot(weights)).ravel()
+
+def _scale(d_mat,scales,both=False):
+    """
+    In place: multiplies row i of d_mat by scales[i], and if both is True
+    column j by scales[j] as well.
+    """
+    if sps.issparse(d_mat):
+        row_scales = np.repeat(scales,np.diff(d_mat.indptr))
+        d_mat.data *= row_scales
+        if both:
+            d_mat.data *= scales[d_mat.indices]
+    else:
+        d_mat *= scales[:,np.newaxis]
+        if both:
+            d_mat *= scales[np.newaxis,:]
+
+def markov_eigs(data,n_eigs,normalize=True,thres=1e-8,v0=None):
+    """
+    data is a (symmetric) affinity matrix, dense or scipy.sparse.
     n_eigs is the number of eigenvalues/eigenvectors desired.
     normalize sets whether to normalize all the eigenvectors such that the first
     eigenvector is 1.   (this function is ncut from the MATLAB questionnaire)
+    v0 is an optional starting vector for the eigensolver, eg the second
+    eigenvector from a similar earlier problem.
     Returns the first n eigenvectors and the corresponding eigenvalues.
     """
-    p_mat = make_markov_symmetric(data,thres)
-    return _calc_eigs(p_mat,n_eigs,normalize,thres)
+    p_mat,top_vector = _markov_symmetric(data,thres)
+    return _calc_eigs(p_mat,n_eigs,normalize,thres,v0,top_vector)
 
-def _calc_eigs(markov_chain,n_eigs,normalize=True,thres=1e-8):
+def _calc_eigs(markov_chain,n_eigs,normalize=True,thres=1e-8,v0=None,
+               top_vector=None):
+    """
+    Top n_eigs eigenpairs (by absolute value) of the symmetric markov_chain.
+    Eigenvalues are returned as absolute values in decreasing order, which
+    is what the svds this replaced gave.
+    If top_vector, the known leading eigenvector, is given, it is deflated
+    and eigsh only looks for the remaining n_eigs-1.
+    """
     n = np.shape(markov_chain)[0]
     n_eigs = min(n_eigs,n)
-    [vectors,singvals,_] = spsl.svds(markov_chain,n_eigs)
-    y = np.argsort(-singvals)
-    eigenvalues = singvals[y]
+    if n <= DENSE_EIGH_MAX_N or n_eigs >= n-1:
+        if sps.issparse(markov_chain):
+            markov_chain = markov_chain.toarray()
+        eigvals,vectors = np.linalg.eigh(markov_chain)
+    elif top_vector is None:
+        if v0 is None:
+            #the top eigenvector of the symmetrized chain is close to the
+            #square root of its row sums.
+            v0 = np.sqrt(np.abs(_rowsums(markov_chain))) + 1e-8
+        eigvals,vectors = spsl.eigsh(markov_chain,n_eigs,which='LM',v0=v0)
+    else:
+        u = top_vector/np.linalg.norm(top_vector)
+        def deflated(x):
+            x = np.asarray(x).reshape(n,-1)
+            return markov_chain.dot(x) - np.outer(u,u.dot(x))
+        op = spsl.LinearOperator((n,n),matvec=deflated,matmat=deflated,
+                                 dtype=np.float)
+        if v0 is None:
+            v0 = np.random.RandomState(0).rand(n) - 0.5
+        v0 = v0 - u*u.dot(v0)
+        if n_eigs > 1:
+            eigvals,vectors = spsl.eigsh(op,n_eigs-1,which='LM',v0=v0)
+        else:
+            eigvals,vectors = np.zeros(0),np.zeros([n,0])
+        eigvals = np.hstack([u.dot(markov_chain.dot(u)),eigvals])
+        vectors = np.hstack([u[:,np.newaxis],vectors])
+    y = np.argsort(-np.abs(eigvals),kind='mergesort')[:n_eigs]
+    eigenvalues = np.abs(eigvals[y])
     eigenvectors = vectors[:,y]
-    
+
     if normalize:
         n_mat = np.hstack([np.reshape([eigenvectors[:,0]],[-1,1])]*n_eigs)
         eigenvectors /= n_mat
         n_mat2 = np.vstack([np.sign(eigenvectors[0,1:])]*n)
         n_mat2[n_mat2==0] = 1.0
         eigenvectors[:,1:] *= n_mat2
-        
+
     return eigenvectors, eigenvalues
-    
\ No newline at end of file
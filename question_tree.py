@@ -5,6 +5,7 @@ question_tree.py: Proof of concept for algorithm for adaptively reducing
                   probability field.
 """
 
+import multiprocessing.pool
 import numpy as np
 import dual_affinity
 import markov
@@ -53,6 +54,15 @@ def break_node(train_data,col_tree_node,row_tree,regressors=None,
 
 def process_node(train_data,row_tree,node_list,regressors=None,col_emd=None):
     node = node_list.pop(0)
+    _process_node(train_data,row_tree,node,regressors,col_emd)
+    if len(node.children) > 1 and node.size >= 15:
+        node_list.extend(node.children)
+
+def _process_node(train_data,row_tree,node,regressors=None,col_emd=None):
+    """
+    Splits node, either into singletons (if it's small) or by break_node.
+    Only touches node, so different nodes can be processed concurrently.
+    """
     if regressors is None:
         regressors = range(row_tree.size)
 
@@ -62,12 +72,14 @@ def process_node(train_data,row_tree,node_list,regressors=None,col_emd=None):
         active,lm = break_node(train_data,node,row_tree,regressors,col_emd=col_emd)
         node.lm = lm
         node.active = active
-        if len(node.children) > 1:
-            node_list.extend(node.children)
 
-def mtree(train_data,row_tree,regressors=None):
+def mtree(train_data,row_tree,regressors=None,n_jobs=1):
     """
     Generates the question tree on the training data.
+    n_jobs > 1 (experimental) splits all the nodes of a level at once on 
+    that many threads. Much of the per-node work (lars_path, the eigsh 
+    iterations) holds the GIL, so no speedup has been measured.
+    Nothing here is random, so the tree doesn't depend on n_jobs.
     """
     root = tree.ClusterTreeNode(range(train_data.shape[1]))
     node_list = []
@@ -77,8 +89,27 @@ def mtree(train_data,row_tree,regressors=None):
 
     col_emd = dual_affinity.calc_emd(train_data,row_tree,alpha=0.0,beta=1.0)
 
-    while node_list:
-        process_node(train_data,row_tree,node_list,regressors,col_emd)
+    def split(node):
+        _process_node(train_data,row_tree,node,regressors,col_emd)
+
+    pool = None
+    if n_jobs > 1:
+        pool = multiprocessing.pool.ThreadPool(n_jobs)
+    try:
+        #level by level; the same nodes get split as with process_node's 
+        #FIFO queue, just a level at a time.
+        while node_list:
+            if pool is None:
+                map(split,node_list)
+            else:
+                pool.map(split,node_list)
+            node_list = [child for node in node_list 
+                         if node.size >= 15 and len(node.children) > 1 
+                         for child in node.children]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     
     fix_leaves(root)
     
@@ -4,11 +4,23 @@ questionnaire.py: Main module for running the questionnaire with
                   PyQuestParams object, and then run pyquest(data,params).
 """
 
+import collections
+import cPickle
 import datetime
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import numpy as np
+import scipy.sparse as sps
 import affinity
 import dual_affinity
 import bin_tree_build
 import flex_tree_build
+import random_util
+import tree_util
+import compact_tree
 
 INIT_AFF_COS_SIM = 0
 INIT_AFF_GAUSSIAN = 1
@@ -16,6 +28,7 @@ INIT_AFF_GAUSSIAN = 1
 DEFAULT_INIT_AFF_THRESHOLD = 0.0
 DEFAULT_INIT_AFF_EPSILON = 1.0
 DEFAULT_INIT_AFF_KNN = 5
+DEFAULT_INIT_AFF_SPARSE_KNN = None
 
 TREE_TYPE_BINARY = 0
 TREE_TYPE_FLEXIBLE = 1
@@ -32,6 +45,13 @@ DEFAULT_DUAL_BETA = 1.0
 
 DEFAULT_N_ITERS = 3
 DEFAULT_N_TREES = 1
+DEFAULT_MAX_ITERS = None
+DEFAULT_TOL = None
+
+DEFAULT_SEED = None
+
+DEFAULT_CACHE_MEMORY_BYTES = 2**30
+DEFAULT_CACHE_DISK_BYTES = 16*2**30
 
 class PyQuestParams(object):
     
@@ -42,6 +62,7 @@ class PyQuestParams(object):
         self.set_tree_type(tree_type,**kwargs)
         self.set_dual_aff(dual_row_type,dual_col_type,**kwargs)
         self.set_iters(**kwargs)
+        self.set_seed(**kwargs)
     
     def set_init_aff(self,affinity_type,**kwargs):
         self.init_aff_type = affinity_type
@@ -60,6 +81,10 @@ class PyQuestParams(object):
                 self.init_aff_knn = kwargs["knn"]
             else:
                 self.init_aff_knn = DEFAULT_INIT_AFF_KNN
+            if "sparse_knn" in kwargs:
+                self.init_aff_sparse_knn = kwargs["sparse_knn"]
+            else:
+                self.init_aff_sparse_knn = DEFAULT_INIT_AFF_SPARSE_KNN
         
     def set_tree_type(self,tree_type,**kwargs):
         self.tree_type = tree_type
@@ -118,97 +143,745 @@ class PyQuestParams(object):
             print "default n_iters"
             self.n_iters = DEFAULT_N_ITERS
         
+        #n_trees > 1 runs an ensemble of chains of random dyadic trees (see
+        #pyquest_iter). Only binary trees are random: flexible trees are
+        #the same in every chain, so they are built once.
         if "n_trees" in kwargs:
             self.n_trees = kwargs["n_trees"]
         else:
             self.n_trees = DEFAULT_N_TREES
+        
+        #with tol set, iterations stop once the dual affinities change by at
+        #most tol (see PyQuestRun.convergence), or after max_iters (n_iters
+        #if max_iters is None). On noisy data the trees keep changing a 
+        #little, so tol should be above that floor (on SN_basic, about 0.02 
+        #for binary and 0.03 for flexible trees).
+        if "max_iters" in kwargs:
+            self.max_iters = kwargs["max_iters"]
+        else:
+            self.max_iters = DEFAULT_MAX_ITERS
+        if "tol" in kwargs:
+            self.tol = kwargs["tol"]
+        else:
+            self.tol = DEFAULT_TOL
+            
+    def set_seed(self,**kwargs):
+        """
+        seed (an int; see random_util) makes the random tree builds 
+        reproducible. Each tree of the run gets its own stream spawned from
+        it. None (the default) draws from np.random.
+        """
+        if "seed" in kwargs:
+            self.seed = kwargs["seed"]
+        else:
+            self.seed = DEFAULT_SEED
             
 class PyQuestRun(object):
     """
     Holds the results of a run of the questionnaire, which are basically:
     a description of when the run was done, the trees which were generated on
     each iteration, and the parameters.
+    convergence has an entry for each iteration: how much the affinities 
+    its trees were built on changed from those of the iteration before, as
+    the larger relative change (in the Frobenius norm) of the column and 
+    the row affinity; 1.0 for the first iteration.
+    row_tree_chains and col_tree_chains have the trees of each chain of an
+    ensemble run (params.n_trees > 1); row_trees and col_trees are those of
+    the first chain.
     """
     def __init__(self,run_desc,row_trees,col_trees,row_tree_descs,
-                 col_tree_descs,params):
+                 col_tree_descs,params,convergence=None,row_tree_chains=None,
+                 col_tree_chains=None):
         self.run_desc = run_desc
-        self.row_trees = row_trees
-        self.col_trees = col_trees
+        if row_tree_chains is None:
+            row_tree_chains = [row_trees]
+        if col_tree_chains is None:
+            col_tree_chains = [col_trees]
+        self.row_tree_chains = row_tree_chains
+        self.col_tree_chains = col_tree_chains
+        self.row_trees = row_tree_chains[0]
+        self.col_trees = col_tree_chains[0]
         self.row_tree_descs = row_tree_descs
         self.col_tree_descs = col_tree_descs
         self.params = params
+        if convergence is None:
+            convergence = []
+        self.convergence = convergence
         
 
-def pyquest(data,params):
+def pyquest(data,params,cache=None,checkpoint=None,callback=None,
+            n_jobs=1):
     """
     Runs the questionnaire on data with params. 
     params is a PyQuestParams object.
+    cache is an optional PyQuestCache; stages found in it (eg all but the 
+    last iteration when n_iters is increased by one) are loaded instead of
+    computed.
+    checkpoint, callback and n_jobs are as for pyquest_iter; 
+    callback(message,tree,run) is called with each step it yields.
+    """
+    run = None
+    for message,new_tree,run in pyquest_iter(data,params,cache,checkpoint,
+                                             n_jobs):
+        if callback is not None:
+            callback(message,new_tree,run)
+    return run
+
+def pyquest_iter(data,params,cache=None,checkpoint=None,n_jobs=1):
     """
+    Runs pyquest as a generator, yielding (message,tree,run) as it goes:
+    tree is the new row or column tree when one has just been built (and
+    None for progress messages), and run is the PyQuestRun so far, which 
+    is extended in place. Stopping early leaves run with the trees of the
+    completed iterations.
+    checkpoint is an optional filename. The run is saved there after the 
+    initial tree and after each iteration, replacing the file atomically, 
+    and if the file already exists the run is resumed from it. Resuming 
+    with a larger n_iters extends a finished run. A checkpoint made for 
+    other data or parameters raises ValueError.
+    With params.n_trees > 1, that many chains of trees are built, each 
+    with its own random streams, and every tree is built on the affinity 
+    from the EMDs averaged over the trees of all the chains, and tree is 
+    the tree of the first chain. With n_jobs > 1, the trees of the chains 
+    are built by a pool of that many forked processes, started once and 
+    used for every stage. Process pools need fork, so use n_jobs=1 on 
+    Windows or within the workers of another pool. Ensembles only make sense 
+    for the random TREE_TYPE_BINARY trees; TREE_TYPE_FLEXIBLE trees are 
+    deterministic, so every chain gets the same tree, built once.
+    """
+    if not _dual_supported(params):
+        return
+    stages = _PyQuestStages(data,params,cache,n_jobs=n_jobs)
+    try:
+        run = None
+        if checkpoint is not None:
+            checkpoint_key = _checkpoint_key(data,params,stages.data_key)
+            run = _load_checkpoint(checkpoint,checkpoint_key,params)
+        if run is None:
+            init_row_trees = stages.trees(stages.init_aff_key,
+                                          lambda: init_row_affinity(data,
+                                                                    params),
+                                          0)
+            run = _new_run(params,init_row_trees)
+            if checkpoint is not None:
+                _save_checkpoint(checkpoint,checkpoint_key,run)
+            yield "Initial tree",run.row_trees[0],run
+        else:
+            yield ("Resumed from checkpoint after {} iterations".format(
+                       len(run.col_trees)),None,run)
+        for step in _pyquest_steps(data,params,run,stages):
+            #an iteration ends with its row tree.
+            if checkpoint is not None and step[1] is run.row_trees[-1]:
+                _save_checkpoint(checkpoint,checkpoint_key,run)
+            yield step
+    finally:
+        stages.close()
 
+def init_row_affinity(data,params):
+    """
+    The affinity between the rows of data that the initial row tree is 
+    built from.
+    """
     if params.init_aff_type == INIT_AFF_COS_SIM:
         init_row_aff = affinity.mutual_cosine_similarity(
                             data.T,False,0,threshold=params.init_aff_threshold)
     elif params.init_aff_type == INIT_AFF_GAUSSIAN:
         init_row_aff = affinity.gaussian_euclidean(
-                            data.T, params.init_aff_knn, params.init_aff_epsilon)
-    
-    #Initial row tree
+                            data.T, params.init_aff_knn, params.init_aff_epsilon,
+                            params.init_aff_sparse_knn)
+    return init_row_aff
+
+def _build_tree(aff,params,seed):
+    """
+    Builds a tree of the type in params on aff, with the random seed seed.
+    """
     if params.tree_type == TREE_TYPE_BINARY:
-        init_row_tree = bin_tree_build.bin_tree_build(init_row_aff,'r_dyadic',
-                                                      params.tree_bal_constant)
+        return bin_tree_build.bin_tree_build(aff,'r_dyadic',
+                                             params.tree_bal_constant,
+                                             seed=seed)
     elif params.tree_type == TREE_TYPE_FLEXIBLE:
-        init_row_tree = flex_tree_build.flex_tree_diffusion(init_row_aff,
-                                            params.tree_constant)
-    dual_col_trees = []
-    dual_row_trees = [init_row_tree]
-    
-    row_tree_descs = ["Initial tree"]
-    col_tree_descs = []
-    
-    for i in xrange(params.n_iters):
-        message = "Iteration {}: calculating column affinity...".format(i)
-
-        #print "Beginning iteration {}".format(i)
-        if params.col_affinity_type == DUAL_EMD:
-            col_emd = dual_affinity.calc_emd(data,dual_row_trees[-1],
-                     params.col_alpha,params.col_beta)
-            col_aff = dual_affinity.emd_dual_aff(col_emd)
-        elif params.col_affinity_type == DUAL_GAUSSIAN:
-            print "Gaussian dual affinity not supported at the moment."
-            return None
-        
+        return flex_tree_build.flex_tree_diffusion(aff,params.tree_constant)
+
+def _chain_tree_job(job):
+    #the pool outlives the stage, so the affinity comes from .npy files 
+    #written once per stage; memory mapped, the workers share one copy.
+    directory,names,params,seed = job
+    aff = _from_arrays(dict([(x,np.load(os.path.join(directory,x+".npy"),
+                                        mmap_mode="r")) for x in names]))
+    return _to_arrays(_build_tree(aff,params,seed))
+
+def _dual_supported(params):
+    if DUAL_GAUSSIAN in (params.col_affinity_type,params.row_affinity_type):
+        print "Gaussian dual affinity not supported at the moment."
+        return False
+    return True
+
+def _new_run(params,init_row_trees):
+    return PyQuestRun("{}".format(datetime.datetime.now()),None,None,
+                      ["Initial tree"],[],params,
+                      row_tree_chains=[[x] for x in init_row_trees],
+                      col_tree_chains=[[] for _ in init_row_trees])
+
+def _pyquest_iterations(data,params,init_row_trees,stages=None):
+    """
+    The dual iterations of pyquest, starting from the initial row tree of
+    each chain in init_row_trees.
+    """
+    if not _dual_supported(params):
+        return None
+    run = _new_run(params,init_row_trees)
+    for _ in _pyquest_steps(data,params,run,stages):
+        pass
+    return run
+
+def _pyquest_steps(data,params,run,stages=None):
+    """
+    Generator doing the dual iterations of pyquest that run does not have
+    yet, yielding the steps of pyquest_iter.
+    """
+    if stages is None:
+        stages = _PyQuestStages(data,params)
+    
+    #consecutive trees tend to share most of their folders, so the EMDs are
+    #updated rather than recomputed. Ensembles average the EMDs of all
+    #their trees instead.
+    col_emd_engine = dual_affinity.IncrementalEMD(data,params.col_alpha,
+                                                  params.col_beta)
+    row_emd_engine = dual_affinity.IncrementalEMD(data.T,params.row_alpha,
+                                                  params.row_beta)
+    #the chains only differ if the trees are random.
+    n_chains = _n_random_chains(params)
+    #the affinities of the last iteration, for the convergence trace.
+    last_affs = {}
+    def col_aff(row_trees):
+        row_trees = row_trees[:n_chains]
+        if len(row_trees) == 1:
+            col_emd = col_emd_engine.update(row_trees[0])
+        else:
+            col_emd = dual_affinity.calc_emd_mean(data,row_trees,
+                                                  params.col_alpha,
+                                                  params.col_beta,
+                                                  n_jobs=stages.n_jobs)
+        return dual_affinity.emd_dual_aff(col_emd)
+    def row_aff(col_trees):
+        col_trees = col_trees[:n_chains]
+        if len(col_trees) == 1:
+            row_emd = row_emd_engine.update(col_trees[0])
+        else:
+            row_emd = dual_affinity.calc_emd_mean(data.T,col_trees,
+                                                  params.row_alpha,
+                                                  params.row_beta,
+                                                  n_jobs=stages.n_jobs)
+        return dual_affinity.emd_dual_aff(row_emd)
+    def iteration_aff(kind,i):
+        #the key of and the affinity the kind trees of iteration i are built
+        #on, from the cache if it has it.
+        if kind == "col":
+            dual_trees = [x[i] for x in run.row_tree_chains]
+            compute = lambda: col_aff(dual_trees)
+        else:
+            dual_trees = [x[i] for x in run.col_tree_chains]
+            compute = lambda: row_aff(dual_trees)
+        key = stages.dual_aff_key(kind,dual_trees)
+        return key,stages.affinity(key,compute)
+    def aff_change(i,affs):
+        if i == 0:
+            return 1.0
+        if i-1 not in last_affs:
+            #resumed, so the last iteration's affinities are recomputed.
+            last_affs[i-1] = (iteration_aff("col",i-1)[1],
+                              iteration_aff("row",i-1)[1])
+        return max([_relative_change(x,y) for x,y in zip(affs,
+                                                          last_affs[i-1])])
+    
+    max_iters = params.n_iters if params.max_iters is None else params.max_iters
+    for i in xrange(len(run.col_trees),max_iters):
+        if (params.tol is not None and run.convergence and 
+                run.convergence[-1] <= params.tol):
+            yield "Converged after {} iterations".format(i),None,run
+            break
         message = "Iteration {}: calculating column tree...".format(i)
+        yield message,None,run
+
+        col_key,col_affinity = iteration_aff("col",i)
+        col_trees = stages.trees(col_key,lambda: col_affinity,1,i)
+        for chain,col_tree in zip(run.col_tree_chains,col_trees):
+            chain.append(col_tree)
+        run.col_tree_descs.append("Iteration {}".format(i))
+        yield "Iteration {}: column tree".format(i),col_trees[0],run
 
-        if params.tree_type == TREE_TYPE_BINARY:
-            col_tree = bin_tree_build.bin_tree_build(col_aff,'r_dyadic',
-                                                     params.tree_bal_constant)
-        elif params.tree_type == TREE_TYPE_FLEXIBLE:
-            col_tree = flex_tree_build.flex_tree_diffusion(col_aff,
-                                                           params.tree_constant) 
-        dual_col_trees.append(col_tree)
-        col_tree_descs.append("Iteration {}".format(i))
-
-        message = "Iteration {}: calculating row affinity...".format(i)
-
-        if params.row_affinity_type == DUAL_EMD:
-            row_emd = dual_affinity.calc_emd(data.T,dual_col_trees[-1],
-                     params.row_alpha,params.row_beta)
-            row_aff = dual_affinity.emd_dual_aff(row_emd)
-        elif params.row_affinity_type == DUAL_GAUSSIAN:
-            print "Gaussian dual affinity not supported at the moment."
-            return None
- 
         message = "Iteration {}: calculating row tree...".format(i)
+        yield message,None,run
        
-        if params.tree_type == TREE_TYPE_BINARY:
-            row_tree = bin_tree_build.bin_tree_build(row_aff,'r_dyadic',
-                                                     params.tree_bal_constant)
-        elif params.tree_type == TREE_TYPE_FLEXIBLE:
-            row_tree = flex_tree_build.flex_tree_diffusion(row_aff,
-                                                           params.tree_constant) 
-        dual_row_trees.append(row_tree)
-        row_tree_descs.append("Iteration {}".format(i))
-        quest_run_desc = "{}".format(datetime.datetime.now())
-
-    return PyQuestRun(quest_run_desc,dual_row_trees,dual_col_trees,
-                      row_tree_descs,col_tree_descs,params)
+        row_key,row_affinity = iteration_aff("row",i)
+        row_trees = stages.trees(row_key,lambda: row_affinity,2,i)
+        for chain,row_tree in zip(run.row_tree_chains,row_trees):
+            chain.append(row_tree)
+        run.row_tree_descs.append("Iteration {}".format(i))
+        run.run_desc = "{}".format(datetime.datetime.now())
+        affs = (col_affinity,row_affinity)
+        run.convergence.append(aff_change(i,affs))
+        last_affs.clear()
+        last_affs[i] = affs
+        yield "Iteration {}: row tree".format(i),row_trees[0],run
+
+def _n_random_chains(params):
+    """
+    The number of chains with different trees: params.n_trees for the 
+    random binary trees, one otherwise.
+    """
+    if params.tree_type == TREE_TYPE_BINARY:
+        return params.n_trees
+    return 1
+
+def _relative_change(new,old):
+    """
+    ||new - old||/||old|| in the Frobenius norm, for dense or sparse 
+    affinities.
+    """
+    diff = new - old
+    if sps.issparse(diff):
+        return np.sqrt(diff.multiply(diff).sum()/old.multiply(old).sum())
+    return np.linalg.norm(diff)/np.linalg.norm(old)
+
+def _checkpoint_key(data,params,data_key=None):
+    """
+    Identifies the data and the parameters a checkpoint can be resumed 
+    with: everything but the number of iterations and the stopping rule.
+    """
+    params_items = sorted([(x,y) for x,y in vars(params).items() 
+                           if x not in ("n_iters","max_iters","tol")])
+    return PyQuestCache.key(data_key or PyQuestCache.data_key(data),
+                            params_items)
+
+def _save_checkpoint(filename,checkpoint_key,run):
+    state = {"key":checkpoint_key,
+             "run_desc":run.run_desc,
+             "row_tree_chains":[[_to_arrays(x) for x in y] 
+                                for y in run.row_tree_chains],
+             "col_tree_chains":[[_to_arrays(x) for x in y] 
+                                for y in run.col_tree_chains],
+             "row_tree_descs":run.row_tree_descs,
+             "col_tree_descs":run.col_tree_descs,
+             "convergence":run.convergence}
+    #written under a temporary name and renamed, so a crash while writing
+    #leaves the previous checkpoint intact.
+    tmp_filename = "{}.{}.tmp".format(filename,os.getpid())
+    with open(tmp_filename,"wb") as f:
+        cPickle.dump(state,f,cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_filename,filename)
+
+def _load_checkpoint(filename,checkpoint_key,params):
+    """
+    The PyQuestRun saved in filename, or None if there is no such file.
+    """
+    if not os.path.exists(filename):
+        return None
+    with open(filename,"rb") as f:
+        state = cPickle.load(f)
+    if state["key"] != checkpoint_key:
+        raise ValueError("Checkpoint {} is for different data or "
+                         "parameters.".format(filename))
+    return PyQuestRun(state["run_desc"],None,None,state["row_tree_descs"],
+                      state["col_tree_descs"],params,state["convergence"],
+                      [[_from_arrays(x) for x in y] 
+                       for y in state["row_tree_chains"]],
+                      [[_from_arrays(x) for x in y] 
+                       for y in state["col_tree_chains"]])
+
+class _PyQuestStages(object):
+    """
+    Computes the affinities and trees of one pyquest run, going through
+    cache (a PyQuestCache, or None for no caching).
+    Stage keys chain the hash of data, the parameters of the stage and the 
+    fingerprints of the trees it was computed from, so a tree can be 
+    looked up without its affinity and a run picks up from the last stage 
+    that is in the cache. Binary trees built with no seed are random, and 
+    are never cached.
+    The trees of the chains are built on a pool of n_jobs processes, which
+    is started when first needed and kept until close is called.
+    """
+    def __init__(self,data,params,cache=None,data_key=None,n_jobs=1,
+                 seed=None):
+        self.params = params
+        self.cache = cache
+        self.n_jobs = n_jobs
+        self._pool = None
+        self._work_dir = None
+        #seed stands in for params.seed when that is None.
+        self.seed = params.seed if seed is None else seed
+        if self.seed is None and _n_random_chains(params) > 1:
+            #the forked workers would all continue the same global stream,
+            #so the chains get streams spawned from one draw from it.
+            self.seed = random_util.seed_entropy(
+                random_util.check_random_state(None))
+        if cache is not None:
+            self.data_key = data_key or cache.data_key(data)
+            self.init_aff_key = cache.key("init_aff",self.data_key,
+                                          _init_aff_key(params))
+        else:
+            self.data_key = None
+            self.init_aff_key = None
+    
+    def dual_aff_key(self,kind,dual_trees):
+        if self.cache is None:
+            return None
+        if kind == "col":
+            aff_params = (self.params.col_affinity_type,self.params.col_alpha,
+                          self.params.col_beta)
+        else:
+            aff_params = (self.params.row_affinity_type,self.params.row_alpha,
+                          self.params.row_beta)
+        return self.cache.key(kind+"_aff",self.data_key,aff_params,
+                              tuple([tree_util.tree_fingerprint(x) 
+                                     for x in dual_trees]))
+    
+    def affinity(self,key,compute):
+        if key is None:
+            return compute()
+        aff = self.cache.get(key)
+        if aff is None:
+            aff = compute()
+            self.cache.put(key,aff)
+        return aff
+    
+    def trees(self,aff_key,compute_aff,*seed_keys):
+        """
+        The trees of each of the params.n_trees chains built on the 
+        affinity with key aff_key (computed by compute_aff if needed).
+        seed_keys identify the random stream of the first chain's tree; 
+        chain c > 0 adds c to them. Deterministic trees are built once and
+        shared by all the chains.
+        """
+        n_chains = _n_random_chains(self.params)
+        seeds = [random_util.spawn_seed(self.seed,*seed_keys) if c == 0 else
+                 random_util.spawn_seed(self.seed,*(seed_keys+(c,)))
+                 for c in xrange(n_chains)]
+        keys = [None]*n_chains
+        if aff_key is not None and not (self.params.tree_type == 
+                                        TREE_TYPE_BINARY and 
+                                        self.params.seed is None):
+            keys = [self.cache.key("tree",aff_key,_tree_params_key(self.params),
+                                   x) for x in seeds]
+        trees = [None if x is None else self.cache.get(x) for x in keys]
+        missing = [c for c in xrange(n_chains) if trees[c] is None]
+        if missing:
+            built = self._build_trees(self.affinity(aff_key,compute_aff),
+                                      [seeds[c] for c in missing])
+            for c,new_tree in zip(missing,built):
+                trees[c] = new_tree
+                if keys[c] is not None:
+                    self.cache.put(keys[c],new_tree)
+        return trees + [trees[0]]*(self.params.n_trees - n_chains)
+    
+    def close(self):
+        """
+        Stops the pool and removes its files.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        if self._work_dir is not None:
+            shutil.rmtree(self._work_dir,True)
+            self._work_dir = None
+    
+    def _build_trees(self,aff,seeds):
+        if self.n_jobs == 1 or len(seeds) <= 1:
+            return [_build_tree(aff,self.params,x) for x in seeds]
+        if self._pool is None:
+            self._work_dir = tempfile.mkdtemp(prefix="pyquest")
+            self._pool = multiprocessing.Pool(
+                min(self.n_jobs,_n_random_chains(self.params)))
+        arrays = _to_arrays(aff)
+        paths = [os.path.join(self._work_dir,x+".npy") for x in arrays]
+        try:
+            for path,x in zip(paths,arrays.values()):
+                np.save(path,x)
+            built = self._pool.map(_chain_tree_job,
+                                   [(self._work_dir,arrays.keys(),self.params,
+                                     x) for x in seeds],chunksize=1)
+        finally:
+            for path in paths:
+                _remove(path)
+        return [_from_arrays(x) for x in built]
+
+class PyQuestCache(object):
+    """
+    Content-addressed store for the affinities and trees computed by 
+    pyquest, keyed by hex digests (see key and data_key). Recently used 
+    entries are kept in memory up to max_memory_bytes, and if directory is
+    given, on disk up to max_disk_bytes: affinities as .npy (.npz if 
+    sparse) and trees as the arrays of a compact_tree.CompactTree. The 
+    least recently used entries are dropped first. Several processes can 
+    share a directory.
+    Trees come back as new indexed ClusterTreeNode trees; extra attributes 
+    on the nodes are not stored. Affinities come back read-only.
+    """
+    def __init__(self,directory=None,max_memory_bytes=DEFAULT_CACHE_MEMORY_BYTES,
+                 max_disk_bytes=DEFAULT_CACHE_DISK_BYTES):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+    
+    @staticmethod
+    def key(*parts):
+        """
+        Digest of parts (strings, numbers, None and tuples of these).
+        """
+        return hashlib.sha1(repr(parts)).hexdigest()
+    
+    @staticmethod
+    def data_key(data):
+        """
+        Digest of the shape, type and contents of the array data.
+        """
+        data = np.ascontiguousarray(data)
+        sha = hashlib.sha1(repr((data.shape,data.dtype.str)))
+        sha.update(data.data)
+        return sha.hexdigest()
+    
+    def get(self,key):
+        """
+        The affinity or tree stored under key, or None.
+        """
+        if key in self._memory:
+            self._memory[key] = self._memory.pop(key)
+            value = self._memory[key][1]
+        else:
+            value = self._disk_get(key)
+            if value is not None:
+                self._memory_put(key,value)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return _from_arrays(value)
+    
+    def put(self,key,value):
+        """
+        Stores an affinity (dense or scipy.sparse) or a tree under key. 
+        Affinities are not copied, so they must not be changed afterwards.
+        """
+        arrays = _to_arrays(value)
+        self._memory_put(key,arrays)
+        nbytes = sum([x.nbytes for x in arrays.values()])
+        if self.directory is not None and nbytes <= self.max_disk_bytes:
+            self._disk_put(key,arrays)
+    
+    def clear(self):
+        self._memory.clear()
+        self._memory_bytes = 0
+        for path in self._disk_files():
+            _remove(path)
+    
+    def _memory_put(self,key,arrays):
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key)[0]
+        nbytes = sum([x.nbytes for x in arrays.values()])
+        if nbytes > self.max_memory_bytes:
+            return
+        self._memory[key] = (nbytes,arrays)
+        self._memory_bytes += nbytes
+        while self._memory_bytes > self.max_memory_bytes:
+            self._memory_bytes -= self._memory.popitem(last=False)[1][0]
+    
+    def _paths(self,key):
+        return [os.path.join(self.directory,key+x) for x in (".npy",".npz")]
+    
+    def _disk_get(self,key):
+        if self.directory is None:
+            return None
+        for path in self._paths(key):
+            try:
+                if path.endswith(".npy"):
+                    arrays = {"affinity":np.load(path)}
+                else:
+                    with np.load(path) as npz:
+                        arrays = dict(npz.items())
+            except IOError:
+                continue
+            try:
+                os.utime(path,None)
+            except OSError:
+                pass
+            for x in arrays.values():
+                x.flags.writeable = False
+            return arrays
+        return None
+    
+    def _disk_put(self,key,arrays):
+        #written under a temporary name and renamed, so other processes
+        #never see a partial file.
+        path = self._paths(key)[0 if arrays.keys() == ["affinity"] else 1]
+        tmp_path = "{}.{}.tmp".format(path,os.getpid())
+        with open(tmp_path,"wb") as f:
+            if path.endswith(".npy"):
+                np.save(f,arrays["affinity"])
+            else:
+                np.savez(f,**arrays)
+        os.rename(tmp_path,path)
+        files = []
+        for x in self._disk_files():
+            try:
+                stat = os.stat(x)
+            except OSError:
+                continue
+            files.append((stat.st_mtime,stat.st_size,x))
+        files.sort()
+        total = sum([x[1] for x in files])
+        for _,size,x in files:
+            if total <= self.max_disk_bytes:
+                break
+            _remove(x)
+            total -= size
+    
+    def _disk_files(self):
+        if self.directory is None:
+            return []
+        return [os.path.join(self.directory,x) 
+                for x in os.listdir(self.directory)
+                if x.endswith(".npy") or x.endswith(".npz")]
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+_TREE_ARRAYS = ["order","parents","levels","offsets","sizes","child_start",
+                "child_idx"]
+
+def _to_arrays(value):
+    """
+    The arrays PyQuestCache stores value (an affinity or a tree) as. They 
+    are read-only views, not copies, so value must not be changed later.
+    """
+    if sps.issparse(value):
+        value = sps.csr_matrix(value)
+        arrays = {"data":value.data,"indices":value.indices,
+                  "indptr":value.indptr,"shape":np.array(value.shape)}
+    elif isinstance(value,np.ndarray):
+        arrays = {"affinity":value}
+    else:
+        if not isinstance(value,compact_tree.CompactTree):
+            value = compact_tree.CompactTree.from_cluster_tree(value)
+        arrays = dict([(x,getattr(value,x)) for x in _TREE_ARRAYS])
+    #views, so that making them read-only leaves value's arrays alone.
+    arrays = dict([(x,np.asarray(y).view()) for x,y in arrays.items()])
+    for x in arrays.values():
+        x.flags.writeable = False
+    return arrays
+
+def _from_arrays(arrays):
+    if "affinity" in arrays:
+        return arrays["affinity"]
+    if "indptr" in arrays:
+        return sps.csr_matrix((arrays["data"],arrays["indices"],
+                               arrays["indptr"]),shape=tuple(arrays["shape"]))
+    return compact_tree.CompactTree(**arrays).to_cluster_tree()
+
+def _init_aff_key(params):
+    """
+    The parameters the initial row affinity depends on.
+    """
+    if params.init_aff_type == INIT_AFF_COS_SIM:
+        return (INIT_AFF_COS_SIM,params.init_aff_threshold)
+    return (params.init_aff_type,params.init_aff_epsilon,params.init_aff_knn,
+            params.init_aff_sparse_knn)
+
+def _tree_params_key(params):
+    """
+    The parameters (other than the seed) that tree building depends on.
+    """
+    if params.tree_type == TREE_TYPE_BINARY:
+        return (TREE_TYPE_BINARY,params.tree_bal_constant)
+    return (params.tree_type,params.tree_constant)
+
+def _init_tree_key(params,seed):
+    """
+    The parameters the initial row tree depends on, with seed the seed 
+    the run uses.
+    """
+    if params.tree_type == TREE_TYPE_BINARY:
+        return (_init_aff_key(params),_tree_params_key(params),params.n_trees,
+                random_util.spawn_seed(seed,0))
+    return (_init_aff_key(params),_tree_params_key(params),params.n_trees)
+
+#what the forked workers of pyquest_sweep read the data and initial trees
+#from, so neither is pickled per job.
+_sweep_inputs = None
+
+def _sweep_job(job):
+    data,params_list,seeds,init_trees,cache,data_key = _sweep_inputs
+    params = params_list[job]
+    stages = _PyQuestStages(data,params,cache,data_key,seed=seeds[job])
+    return _pyquest_iterations(data,params,
+                               init_trees[_init_tree_key(params,seeds[job])],
+                               stages)
+
+def pyquest_sweep(data,params_list,n_jobs=1,cache=None):
+    """
+    Runs pyquest(data,params) for each PyQuestParams in params_list and
+    returns the list of PyQuestRuns.
+    The initial row affinity is computed once for each distinct setting of
+    its parameters, and the initial row tree once for each distinct setting 
+    of the tree parameters (and seed) on top of it; runs that agree on them 
+    share the same tree objects. Runs with a seed of None get seeds drawn 
+    from np.random here, so they are independent of each other (also in 
+    different processes), just like separate pyquest calls.
+    The iterations of the runs are then spread over n_jobs forked 
+    processes, which see data without copying it. Process pools need fork, 
+    so use n_jobs=1 on Windows. The chains of ensemble runs (n_trees > 1) 
+    are built one after another within each run.
+    cache is an optional PyQuestCache, as for pyquest. Its in-memory part 
+    is not shared between the processes, so give it a directory when 
+    n_jobs > 1.
+    """
+    global _sweep_inputs
+    data_key = None if cache is None else cache.data_key(data)
+    #forked workers all inherit the same np.random state.
+    seeds = [random_util.seed_entropy(random_util.check_random_state(None))
+             if params.seed is None else params.seed for params in params_list]
+    init_affs = {}
+    init_trees = {}
+    for params,seed in zip(params_list,seeds):
+        tree_key = _init_tree_key(params,seed)
+        if tree_key not in init_trees:
+            def compute_aff(params=params):
+                aff_key = _init_aff_key(params)
+                if aff_key not in init_affs:
+                    init_affs[aff_key] = init_row_affinity(data,params)
+                return init_affs[aff_key]
+            stages = _PyQuestStages(data,params,cache,data_key,seed=seed)
+            init_trees[tree_key] = stages.trees(stages.init_aff_key,
+                                                compute_aff,0)
+    init_affs.clear()
+    
+    _sweep_inputs = (data,params_list,seeds,init_trees,cache,data_key)
+    try:
+        jobs = range(len(params_list))
+        if n_jobs == 1 or len(jobs) <= 1:
+            return [_sweep_job(job) for job in jobs]
+        pool = multiprocessing.Pool(min(n_jobs,len(jobs)))
+        try:
+            runs = pool.map(_sweep_job,jobs,chunksize=1)
+        finally:
+            pool.terminate()
+    finally:
+        _sweep_inputs = None
+    #the runs come back from the workers as copies; put the shared initial 
+    #trees and the callers' params back in.
+    for params,seed,run in zip(params_list,seeds,runs):
+        if run is not None:
+            for chain,init_tree in zip(run.row_tree_chains,
+                                       init_trees[_init_tree_key(params,
+                                                                 seed)]):
+                chain[0] = init_tree
+            run.params = params
+    return runs
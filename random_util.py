@@ -0,0 +1,79 @@
+"""
+random_util.py: Seeding helpers shared by the randomized tree builders and
+                data generators, so that runs can be reproduced exactly.
+"""
+
+import numpy as np
+
+MAX_SEED = 2**31-1
+
+def check_random_state(seed):
+    """
+    Turns seed into something to draw random numbers from:
+    None:                       the global np.random state (old behaviour).
+    int or sequence of ints:    a new np.random.RandomState(seed).
+    RandomState or Generator:   seed itself.
+    Use randint and rand below to draw from the result, since RandomState and
+    Generator name their methods differently.
+    """
+    if seed is None:
+        return np.random.mtrand._rand
+    if isinstance(seed,np.random.RandomState) or _is_generator(seed):
+        return seed
+    return np.random.RandomState(seed)
+
+def _is_generator(seed):
+    #numpy.random.Generator only exists in numpy >= 1.17.
+    return hasattr(seed,"integers") and hasattr(seed,"bit_generator")
+
+def randint(random_state,low,high=None,size=None):
+    """
+    Random integers on [low,high) from a RandomState or Generator.
+    """
+    if _is_generator(random_state):
+        return random_state.integers(low,high,size)
+    return random_state.randint(low,high,size)
+
+def rand(random_state,*shape):
+    """
+    Uniform random numbers on [0,1) of the given shape from a RandomState or
+    Generator.
+    """
+    if _is_generator(random_state):
+        return random_state.random(shape if shape else None)
+    return random_state.rand(*shape)
+
+def seed_entropy(seed):
+    """
+    Reduces seed to a single int that child streams are derived from.
+    Ints are kept as they are; random states are drawn from once.
+    Returns None for None.
+    """
+    if seed is None:
+        return None
+    if isinstance(seed,(int,long,np.integer)):
+        return int(seed)
+    return int(randint(check_random_state(seed),0,MAX_SEED))
+
+def spawn_seed(seed,*keys):
+    """
+    Returns an int seed for the child stream of seed identified by keys
+    (ints, eg a node's level and smallest element, or an iteration number).
+    The child only depends on seed and keys, not on what has been drawn from
+    other streams, so children can be used in any order or in parallel.
+    Returns None if seed is None.
+    """
+    entropy = seed_entropy(seed)
+    if entropy is None:
+        return None
+    return int(np.random.RandomState([entropy]+list(keys)).randint(MAX_SEED))
+
+def spawn_random_state(seed,*keys):
+    """
+    Like spawn_seed, but returns the child RandomState itself; for None,
+    the global np.random state.
+    """
+    entropy = seed_entropy(seed)
+    if entropy is None:
+        return check_random_state(None)
+    return np.random.RandomState([entropy]+list(keys))
@@ -4,7 +4,20 @@ tree.py: Defines a tree structure for use in the questionnaire.
 
 import copy
 
+def _min_element(node):
+    return node.elements[0]
+
 class ClusterTreeNode(object):
+    #per-node values precomputed by make_index(). None means not cached, in
+    #which case the properties compute them the slow way.
+    _level = None
+    _tree_depth = None
+    _tree_size = None
+    _frozen = False
+    #per-tree derived data (eg tree_util.folder_indicator), kept on the root
+    #and dropped by make_index() or any structural change.
+    _cache = None
+
     def __init__(self,elements,parent=None):
         self.parent = parent
         self.elements = sorted(set(elements))
@@ -54,6 +67,7 @@ class ClusterTreeNode(object):
         Useful for top-down clustering.
         """
         assert len(partition) == len(self.elements)
+        self._invalidate()
         p_elements = set(partition)
         for subcluster in sorted(p_elements):
             sc_elements = [x for (x,y) in zip(self.elements,partition) 
@@ -67,6 +81,8 @@ class ClusterTreeNode(object):
         are not already there.
         Useful for bottom-up clustering.
         """
+        self._invalidate()
+        parent._invalidate()
         self.parent = parent
         parent.children.append(self)
         parent.elements.extend(self.elements)
@@ -79,18 +95,19 @@ class ClusterTreeNode(object):
         Left here for compatibility reasons, may become a _ method later.
         Later note: okay to use for non-root nodes of the tree.
         """
-        #BFS
-        queue = []
+        #level by level BFS; each level is ordered by smallest element.
+        #elements are kept sorted, so elements[0] is the node's minimum.
         traversal = []
-        queue.append(self)
-        while len(queue) > 0:
-            node = queue.pop(0)
-            traversal.append(node)
-            if floor_level is None:
-                queue.extend(node.children)
-            elif node.level <= floor_level - 1:
-                queue.extend(node.children)
-        traversal.sort(key=lambda x:x.level*1e10+min(x.elements))    
+        level_nodes = [self]
+        level = self.level
+        while level_nodes:
+            level_nodes.sort(key=_min_element)
+            traversal.extend(level_nodes)
+            if floor_level is not None and level >= floor_level:
+                break
+            level_nodes = [child for node in level_nodes 
+                           for child in node.children]
+            level += 1
         return traversal
     
     def dfs_leaves(self):
@@ -138,6 +155,8 @@ class ClusterTreeNode(object):
         """
         Returns the total size of the tree rooted at this node.
         """
+        if self._tree_size is not None:
+            return self._tree_size
         if self.parent is None:
             return len([x for x in self.nodes_list])
         else:
@@ -149,6 +168,8 @@ class ClusterTreeNode(object):
         Returns the level of the tree at which this node sits.
         Indexed starting at 1. This might be changed in the future.
         """
+        if self._level is not None:
+            return self._level
         if self.parent is None:
             return 1
         else:
@@ -159,6 +180,8 @@ class ClusterTreeNode(object):
         """
         Returns the depth in levels of the tree rooted at this node.
         """
+        if self._tree_depth is not None:
+            return self._tree_depth
         if self.children == []:
             return 1
         else:
@@ -196,12 +219,63 @@ class ClusterTreeNode(object):
         """
         Precalculates some things and makes the tree much easier to use.
         Needs to be called after tree construction is finished in all cases.
-        """
+        Caches level, tree_size and tree_depth on every node and freezes the
+        tree; any later structural change (create_subclusters,
+        assign_to_parent) drops the cached values again until the next call.
+        """
+        self._invalidate()
+        self._cache = None
+        self._level = self.level
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for child in node.children:
+                child._level = node._level + 1
+                stack.append(child)
         idx = 0
         self.nodes_list = self.traverse()
         for node in self.nodes_list:
             node.idx = idx
             idx += 1
+        for node in reversed(self.nodes_list):
+            if node.children:
+                node._tree_size = 1 + sum([x._tree_size for x in 
+                                           node.children])
+                node._tree_depth = 1 + node.children[0]._tree_depth
+            else:
+                node._tree_size = 1
+                node._tree_depth = 1
+        self._frozen = True
+
+    @property
+    def frozen(self):
+        """
+        True if the tree this node belongs to has been indexed and not
+        modified since.
+        """
+        return self._root()._frozen
+
+    def _root(self):
+        curnode = self
+        while curnode.parent is not None:
+            curnode = curnode.parent
+        return curnode
+
+    def _invalidate(self):
+        """
+        Clears the values cached by make_index() for any indexed tree
+        containing this node. Called before any structural change.
+        """
+        curnode = self
+        while curnode is not None:
+            if curnode._frozen:
+                for node in curnode.nodes_list:
+                    node._level = None
+                    node._tree_depth = None
+                    node._tree_size = None
+                    node._frozen = False
+                    node._cache = None
+            curnode = curnode.parent
             
     def disp_tree(self):
         """
@@ -297,4 +371,32 @@ def dyadic_tree(n):
 
     tree_list[0].make_index()
 
-    return tree_list[0]
\ No newline at end of file
+    return tree_list[0]
+if __name__ == "__main__":
+    #times make_index and traverse on balanced binary trees with a random 
+    #leaf order: python tree.py [log2 of the number of leaves ...]
+    import random
+    import sys
+    import time
+    
+    sizes = [int(x) for x in sys.argv[1:]] or [14,17,20]
+    for log_n in sizes:
+        random.seed(0)
+        root = ClusterTreeNode(range(2**log_n))
+        level_nodes = [root]
+        for _ in xrange(log_n):
+            for node in level_nodes:
+                half = len(node.elements)//2
+                partition = [0]*half + [1]*half
+                random.shuffle(partition)
+                node.create_subclusters(partition)
+            level_nodes = [child for node in level_nodes 
+                           for child in node.children]
+        start = time.time()
+        root.make_index()
+        index_time = time.time() - start
+        start = time.time()
+        root.traverse()
+        traverse_time = time.time() - start
+        print "2^{} leaves, {} nodes: make_index {:.2f}s, traverse {:.2f}s".format(
+            log_n,len(root),index_time,traverse_time)
@@ -42,46 +42,111 @@ def sure(haar_coefs,t,estimated_var=1.0):
     term3 = np.sum(np.minimum(np.abs(haar_coefs),t)**2)
     return estimated_var*(term1 - term2) + term3,(term1,term2,term3)
 
-def recon_1d_sure(data,tree,estimated_var=1.0):
+def _mad_var(abs_coefs):
+    """
+    Estimates the noise variance of a set of coefficients from their median
+    absolute value (the coefficients are assumed centered at 0).
+    """
+    return (np.median(abs_coefs)/0.6745)**2
+
+def _grid_thresholds(coefs,groups,estimated_var=1.0):
+    """
+    For each group of coefs, the threshold in np.arange(0,6,0.1) minimizing
+    sure(); groups of a single coefficient get 0.
+    """
+    n_groups = np.max(groups)+1
+    thresholds = np.zeros(n_groups)
+    x = np.arange(0,6.0,0.1)
+    for group in xrange(n_groups):
+        hc = coefs[groups==group]
+        if len(hc) == 1:
+            continue
+        var = _mad_var(np.abs(hc)) if estimated_var is None else estimated_var
+        estimates = [sure(hc,threshold,var)[0] for threshold in x]
+        thresholds[group] = x[np.argmin(estimates)]
+    return thresholds
+
+def _exact_thresholds(coefs,groups,estimated_var=1.0):
+    """
+    For each group of coefs, the soft threshold minimizing sure() over all
+    t >= 0; groups of a single coefficient get 0.
+    Between consecutive |coefs| the risk only grows with t, so the minimum
+    is at t = 0 or at one of the |coefs|. With a = sorted |coefs| of a group
+    of N, the risk at t = a[k-1] is
+        var*(N - 2k) + sum(a[:k]**2) + (N-k)*a[k-1]**2
+    so every group is done with one sort and a few cumulative sums.
+    """
+    a = np.abs(coefs)
+    order = np.lexsort((a,groups))
+    a = a[order]
+    g = groups[order]
+    counts = np.bincount(groups)
+    starts = np.cumsum(counts) - counts
+    if estimated_var is None:
+        var = ((a[starts+(counts-1)//2] + a[starts+counts//2])/2.0/0.6745)**2
+    else:
+        var = estimated_var*np.ones(len(counts))
+    n = counts[g]
+    k = np.arange(1,len(a)+1) - starts[g]
+    sq = np.cumsum(a**2)
+    sq -= (sq[starts] - a[starts]**2)[g]
+    risk = var[g]*(n - 2*k) + sq + (n - k)*a**2
+    #with ties, the last of the tied values has the right count, the others
+    #overestimate; the smallest threshold wins ties in risk.
+    best = np.lexsort((risk,g))[starts]
+    thresholds = a[best]
+    thresholds[var*counts <= risk[best]] = 0.0
+    thresholds[counts == 1] = 0.0
+    return thresholds
+
+def _sure_shrink(coefs,levels,estimated_var,threshold_search):
+    """
+    Soft thresholds each set of coefs at the same level by its SURE 
+    threshold.
+    """
+    _,groups = np.unique(levels,return_inverse=True)
+    groups = groups.reshape(np.shape(coefs))
+    if threshold_search == "exact":
+        thresholds = _exact_thresholds(np.ravel(coefs),np.ravel(groups),
+                                       estimated_var)
+    elif threshold_search == "grid":
+        thresholds = _grid_thresholds(coefs,groups,estimated_var)
+    else:
+        raise ValueError("threshold_search must be 'grid' or 'exact'")
+    return shrink_coefs(coefs,thresholds[groups])
+
+def recon_1d_sure(data,tree,estimated_var=1.0,threshold_search="grid"):
     """
     Reconstruction of a function in one dimension using SURE wavelet shrinkage.
+    threshold_search is "grid" (thresholds 0,0.1,...,5.9) or "exact" (the 
+    SURE minimizer over all thresholds). estimated_var=None estimates the 
+    noise variance separately for each level from the median absolute 
+    coefficient. If data has several columns, each is a separate function
+    and gets its own thresholds.
     """
     haar_coefs = haar.haar_transform(data, tree)
-    new_haar_coefs = np.zeros(haar_coefs.shape)
     coef_levels = haar.level_correspondence(tree)
-    for level in np.unique(coef_levels):
-        hc = haar_coefs[coef_levels==level]
-        if len(hc) == 1:
-            t = 0
-        else:
-            x = np.arange(0,6.0,0.1)
-            estimates = []
-            for threshold in x:
-                estimate = sure(hc,threshold,estimated_var)
-                estimates.append(estimate[0])
-            t = x[np.argmin(estimates)]
-        new_haar_coefs[coef_levels==level] = shrink_coefs(hc,t)
+    if np.ndim(haar_coefs) > 1:
+        #one group per (level,column).
+        n_cols = np.size(haar_coefs)//len(coef_levels)
+        coef_levels = np.add.outer(coef_levels*n_cols,
+                                   np.arange(n_cols)).reshape(
+                                       np.shape(haar_coefs))
+    new_haar_coefs = _sure_shrink(haar_coefs,coef_levels,estimated_var,
+                                  threshold_search)
     return haar.inverse_haar_transform(new_haar_coefs, tree)
 
-def recon_2d_sure(data,row_tree,col_tree,estimated_var=1.0):
+def recon_2d_sure(data,row_tree,col_tree,estimated_var=1.0,
+                  threshold_search="grid"):
     """
     Reconstruction of a function in two dimensions using SURE wavelet shrinkage.
+    threshold_search and estimated_var are as in recon_1d_sure; each 
+    bi-level (row level + col level) is shrunk on its own.
     """
     bihaar_coefs = haar.bihaar_transform(data, row_tree, col_tree)
-    new_bihaar_coefs = np.zeros(bihaar_coefs.shape)
     row_levels = haar.level_correspondence(row_tree)
     col_levels = haar.level_correspondence(col_tree)
     coef_levels = np.add.outer(row_levels,col_levels)
-    for level in np.unique(coef_levels):
-        hc = bihaar_coefs[coef_levels==level]
-        if len(hc) == 1:
-            t = 0
-        else:
-            x = np.arange(0,6.0,0.1)
-            estimates = []
-            for threshold in x:
-                estimate = sure(hc,threshold,estimated_var)
-                estimates.append(estimate[0])
-            t = x[np.argmin(estimates)]
-        new_bihaar_coefs[coef_levels==level] = shrink_coefs(hc,t)
-    return haar.inverse_bihaar_transform(new_bihaar_coefs, row_tree, col_tree)
\ No newline at end of file
+    new_bihaar_coefs = _sure_shrink(bihaar_coefs,coef_levels,estimated_var,
+                                    threshold_search)
+    return haar.inverse_bihaar_transform(new_bihaar_coefs, row_tree, col_tree)
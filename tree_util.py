@@ -1,96 +1,253 @@
 """
 tree_util.py: Defines various tree transforms and averages.
 """
+import hashlib
 import numpy as np
+import scipy.sparse as sps
+import compact_tree
 
-def bitree_sums(data,row_tree,col_tree):
+def _level_blocks(row_tree):
+    """
+    Returns the depth-first leaf order of row_tree and, for each level, the
+    node.idx values of that level's folders in depth-first order together
+    with their (start,size) in the leaf order. Every folder is a contiguous
+    block of the leaf order. Cached on the tree.
+    """
+    cache = _tree_cache(row_tree)
+    if "level_blocks" not in cache:
+        if isinstance(row_tree,compact_tree.CompactTree):
+            ct = row_tree
+        else:
+            ct = compact_tree.CompactTree.from_cluster_tree(row_tree)
+        blocks = []
+        for level in xrange(1,ct.levels.max()+1):
+            idxs = np.flatnonzero(ct.levels == level)
+            idxs = idxs[np.argsort(ct.offsets[idxs],kind="mergesort")]
+            blocks.append((idxs,ct.offsets[idxs],ct.sizes[idxs]))
+        cache["level_blocks"] = (ct.order,blocks)
+    return cache["level_blocks"]
+
+def _block_sums(data,starts,sizes):
+    """
+    Sums the columns of data over the blocks [start,start+size) with a 
+    single np.add.reduceat along the last (contiguous) axis. The blocks must
+    be disjoint and in increasing order.
+    """
+    n = data.shape[1]
+    if starts[0] == 0 and np.all(starts[1:] == (starts+sizes)[:-1]) and \
+       starts[-1]+sizes[-1] == n:
+        return np.add.reduceat(data,starts,axis=1)
+    #blocks with gaps between them: reduce over start,end pairs (padding so
+    #that an end at n is a legal index) and keep every other result.
+    padded = np.hstack([data,np.zeros([data.shape[0],1],data.dtype)])
+    bounds = np.vstack([starts,starts+sizes]).T.ravel()
+    return np.add.reduceat(padded,bounds,axis=1)[:,::2]
+
+def _block_expand(values,starts,sizes,n):
+    """
+    The adjoint of _block_sums, but on rows: returns an array with n rows in
+    which every row of block i is values[i] (0 outside blocks).
+    """
+    expanded = np.repeat(values,sizes,axis=0)
+    if len(starts) > 0 and starts[0] == 0 and expanded.shape[0] == n:
+        return expanded
+    positions = (np.arange(np.sum(sizes)) + 
+                 np.repeat(starts - (np.cumsum(sizes) - sizes),sizes))
+    out = np.zeros((n,)+values.shape[1:],values.dtype)
+    out[positions] = expanded
+    return out
+
+def _tree_sums_levelwise(data,row_tree,keep=None):
+    """
+    Sums the columns of data (already in the leaf order of row_tree) over the
+    folders of row_tree, a level at a time. keep is an optional boolean mask
+    on node.idx selecting which folders to compute. Returns the sums (columns
+    in increasing node.idx order) and the idx values computed.
+    Without keep, a level which has the same coverage as the level below 
+    it is summed from that level's sums instead of from data, so the work
+    shrinks with the number of folders rather than staying at one pass over
+    data per level.
+    """
+    _,blocks = _level_blocks(row_tree)
+    parts = []
+    idx_parts = []
+    below = None
+    for idxs,starts,sizes in reversed(blocks):
+        if keep is not None:
+            mask = keep[idxs]
+            if not np.any(mask):
+                continue
+            idxs,starts,sizes = idxs[mask],starts[mask],sizes[mask]
+            sums = _block_sums(data,starts,sizes)
+        elif below is not None and np.sum(below[1]) == np.sum(sizes):
+            #the folders below are an exact refinement of this level, so each
+            #folder here is a contiguous run of them.
+            sums = np.add.reduceat(below[2],np.searchsorted(below[0],starts),
+                                   axis=1)
+        else:
+            sums = _block_sums(data,starts,sizes)
+        below = (starts,sizes,sums)
+        parts.append(sums)
+        idx_parts.append(idxs)
+    idxs = np.concatenate(idx_parts)
+    order = np.argsort(idxs)
+    return np.hstack(parts)[:,order],idxs[order]
+
+def _bitree_block_sums(data,row_tree,col_tree,row_keep=None,col_keep=None):
+    """
+    Returns the bifolder sums for the selected row and column folders, along
+    with the row and column node.idx values they correspond to.
+    Reductions always run along the contiguous axis, so the data is 
+    transposed (and put in leaf order) before each pass.
+    """
+    row_order,_ = _level_blocks(row_tree)
+    col_order,_ = _level_blocks(col_tree)
+    data_t = np.ascontiguousarray(np.asarray(data).T[:,row_order])
+    row_sums_t,row_idxs = _tree_sums_levelwise(data_t,row_tree,row_keep)
+    row_sums = np.ascontiguousarray(row_sums_t.T[:,col_order])
+    sums,col_idxs = _tree_sums_levelwise(row_sums,col_tree,col_keep)
+    return sums,row_idxs,col_idxs
+
+def _large_folders(row_tree,col_tree,min_frac):
+    """
+    Returns boolean masks on the row and column folders which can be part of
+    a bifolder whose size is at least min_frac of the whole matrix.
+    """
+    row_frac = 1.0*node_sizes(row_tree)/row_tree.size
+    col_frac = 1.0*node_sizes(col_tree)/col_tree.size
+    return row_frac >= min_frac,col_frac >= min_frac
+
+def _sparse_bifolders(values,row_tree,col_tree,row_idxs,col_idxs,min_frac):
+    """
+    Scatters a block of bifolder values into a sparse (row tree_size x 
+    col tree_size) matrix, keeping only bifolders of size >= min_frac.
+    """
+    bsizes = np.outer(node_sizes(row_tree)[row_idxs],
+                      node_sizes(col_tree)[col_idxs])
+    total = 1.0*row_tree.size*col_tree.size
+    rows,cols = np.nonzero(bsizes/total >= min_frac)
+    return sps.csr_matrix((values[rows,cols],(row_idxs[rows],col_idxs[cols])),
+                          shape=(row_tree.tree_size,col_tree.tree_size))
+
+def bitree_sums(data,row_tree,col_tree,min_frac=None):
     """
     data is a 2d matrix. row_tree is a tree on the rows (size m)
     col_tree is a tree on the columns (size n)
     Calculates sum on every bifolder.
     Returns mxn matrix of bifolder sums (indices are the node.idx values)
+    If min_frac is given, only bifolders whose size is at least min_frac of
+    the matrix are computed, and a scipy.sparse matrix is returned.
     """
-    
-    sums = np.zeros([row_tree.tree_size,col_tree.tree_size],data.dtype)
-    m,n = np.shape(data)
-    
-    col_singletons_start = col_tree.tree_size - n
-    row_singletons_start = row_tree.tree_size - m
-    
-    sums[row_singletons_start:,col_singletons_start:] = data
-    
-    for row_node in reversed(row_tree[0:row_singletons_start]):
-        sums[row_node.idx,:] = np.sum(sums[[x.idx for x in 
-                                            row_node.children],:],axis=0)
-    
-    for col_node in reversed(col_tree[0:col_singletons_start]):
-        sums[:,col_node.idx] = np.sum(sums[:,[x.idx for x in 
-                                            col_node.children]],axis=1)
-    
-    return sums
+    if min_frac is None:
+        sums,_,_ = _bitree_block_sums(data,row_tree,col_tree)
+        return sums
+    row_keep,col_keep = _large_folders(row_tree,col_tree,min_frac)
+    sums,row_idxs,col_idxs = _bitree_block_sums(data,row_tree,col_tree,
+                                                row_keep,col_keep)
+    return _sparse_bifolders(sums,row_tree,col_tree,row_idxs,col_idxs,min_frac)
 
 def bifolder_sizes(row_tree,col_tree):
     """
     Returns the raw sizes of the rectangles implied by the folders in 
     row_tree and col_tree.
     """
+    return np.outer(node_sizes(row_tree),node_sizes(col_tree))
 
-    row_sizes = np.array([x.size for x in row_tree])
-    col_sizes = np.array([x.size for x in col_tree])
-
-    return np.outer(row_sizes,col_sizes)
+def _bitree_block_averages(data,row_tree,col_tree,row_keep=None,
+                           col_keep=None):
+    sums,row_idxs,col_idxs = _bitree_block_sums(data,row_tree,col_tree,
+                                                row_keep,col_keep)
+    sizes = np.outer(node_sizes(row_tree)[row_idxs],
+                     node_sizes(col_tree)[col_idxs])
+    return 1.0*sums/sizes,row_idxs,col_idxs
 
-def bitree_averages(data,row_tree,col_tree):
+def bitree_averages(data,row_tree,col_tree,min_frac=None):
     """
     data is a 2d matrix. row_tree is a tree on the rows (tree_size m)
     col_tree is a tree on the columns (tree_size n)
     Calculates mean on every bifolder.
     Returns mxn matrix of bifolder means (indices are the node.idx values)
+    If min_frac is given, only bifolders whose size is at least min_frac of
+    the matrix are computed, and a scipy.sparse matrix is returned.
     """
-    
-    return 1.0*bitree_sums(data,row_tree,col_tree)/bifolder_sizes(row_tree,col_tree)
+    if min_frac is None:
+        avs,_,_ = _bitree_block_averages(data,row_tree,col_tree)
+        return avs
+    row_keep,col_keep = _large_folders(row_tree,col_tree,min_frac)
+    avs,row_idxs,col_idxs = _bitree_block_averages(data,row_tree,col_tree,
+                                                   row_keep,col_keep)
+    return _sparse_bifolders(avs,row_tree,col_tree,row_idxs,col_idxs,min_frac)
 
-def bitree_transform(data,row_tree,col_tree):
+def _parent_positions(row_tree,idxs):
+    """
+    idxs are sorted node.idx values that include the root and are closed 
+    under taking parents. Returns, for idxs[1:] (all but the root), the 
+    positions within idxs of their parents.
+    """
+    return np.searchsorted(idxs,node_parents(row_tree)[idxs[1:]])
+
+def bitree_transform(data,row_tree,col_tree,min_frac=None):
     """
     data is a 2d matrix. row_tree is a tree on the rows (size m)
     col_tree is a tree on the columns (size n)
     Calculates the bitree transform on every bifolder.
     This transform is the martingale difference transform.
     Returns mxn matrix of bifolder means (indices are the node.idx values)
+    If min_frac is given, only bifolders whose size is at least min_frac of
+    the matrix are computed, and a scipy.sparse matrix is returned.
     """
-    avs = bitree_averages(data,row_tree,col_tree)
-    coefs = np.zeros([row_tree.tree_size,col_tree.tree_size])
-
-    adjs = np.zeros([row_tree.tree_size,col_tree.tree_size])
-    
-    for node in row_tree:
-        if node.parent is None:
-            coefs[node.idx,:] = avs[node.idx,:]
-        else:
-            coefs[node.idx,:] = avs[node.idx,:] - avs[node.parent.idx,:]
-
-    for node in col_tree: 
-        if node.parent is None:
-            adjs[:,node.idx] += coefs[:,node.idx]
-        else:
-            coefs[:,node.idx] -= adjs[:,node.parent.idx]
-            adjs[:,node.idx] = coefs[:,node.idx] + adjs[:,node.parent.idx]
-                
-    return coefs
+    if min_frac is None:
+        row_keep,col_keep = None,None
+    else:
+        row_keep,col_keep = _large_folders(row_tree,col_tree,min_frac)
+    avs,row_idxs,col_idxs = _bitree_block_averages(data,row_tree,col_tree,
+                                                   row_keep,col_keep)
+    #the parent of a bifolder is at least as large, so it is always present.
+    coefs = avs.copy()
+    coefs[1:,:] -= avs[_parent_positions(row_tree,row_idxs),:]
+    row_coefs = coefs.copy()
+    coefs[:,1:] -= np.take(row_coefs,_parent_positions(col_tree,col_idxs),
+                           axis=1)
+    if min_frac is None:
+        return coefs
+    return _sparse_bifolders(coefs,row_tree,col_tree,row_idxs,col_idxs,
+                             min_frac)
 
 def inverse_bitree_transform(coefs,row_tree,col_tree,threshold=0.0):
     """
-    coefs is an mxn matrix of bitree coefficients
+    coefs is an mxn matrix of bitree coefficients (dense or scipy.sparse)
     row_tree is a tree on the rows (size m)
     col_tree is a tree on the columns (size n)
     threshold is on [0,1]. Folders that are less than threshold*matrix size
     are excluded from the reconstruction.
     """ 
-    new_coefs = coefs.copy()
-    bsizes = bifolder_sizes(row_tree,col_tree)      
-    folder_frac = 1.0*bsizes/bsizes[0,0]
-    new_coefs *= folder_frac > threshold
-    return inverse_tree_transform(inverse_tree_transform(new_coefs.T,col_tree).T,row_tree)
+    row_sizes = node_sizes(row_tree)
+    col_sizes = node_sizes(col_tree)
+    total = 1.0*row_tree.size*col_tree.size
+    if sps.issparse(coefs):
+        coefs = coefs.tocoo()
+        keep = row_sizes[coefs.row]*col_sizes[coefs.col]/total > threshold
+        new_coefs = sps.csr_matrix((coefs.data[keep],(coefs.row[keep],
+                                                      coefs.col[keep])),
+                                   shape=coefs.shape)
+        matrix = folder_indicator(row_tree).T.dot(new_coefs)
+        return folder_indicator(col_tree).T.dot(matrix.T).T.toarray()
+
+    new_coefs = coefs*(np.outer(row_sizes,col_sizes)/total > threshold)
+    row_order,row_blocks = _level_blocks(row_tree)
+    col_order,col_blocks = _level_blocks(col_tree)
+    #push the coefficients down to the leaves a level at a time, first on
+    #the rows and then on the columns (both in leaf order).
+    matrix = np.zeros([row_tree.size,col_tree.tree_size])
+    for idxs,starts,sizes in row_blocks:
+        matrix += _block_expand(new_coefs[idxs,:],starts,sizes,row_tree.size)
+    matrix = np.ascontiguousarray(matrix.T)
+    recon_t = np.zeros([col_tree.size,row_tree.size])
+    for idxs,starts,sizes in col_blocks:
+        recon_t += _block_expand(matrix[idxs,:],starts,sizes,col_tree.size)
+    result = np.empty([row_tree.size,col_tree.size])
+    result[np.ix_(row_order,col_order)] = recon_t.T
+    return result
 
 def inverse_bitree_transform_level(coefs,row_tree,col_tree,row_level,col_level):
     """
@@ -109,60 +266,135 @@ def inverse_bitree_transform_level(coefs,row_tree,col_tree,row_level,col_level):
         new_coefs[:,n] = 0.0
     return inverse_tree_transform(inverse_tree_transform(new_coefs.T,col_tree).T,row_tree)
 
+def _tree_cache(row_tree):
+    """
+    Returns the dict in which per-tree derived data is kept. It lives on the
+    tree itself, so it goes away with the tree (and ClusterTreeNode trees
+    drop it on make_index or any structural change).
+    """
+    if row_tree._cache is None:
+        row_tree._cache = {}
+    return row_tree._cache
+
+def node_sizes(row_tree):
+    """
+    Returns an array (size tree_size) with the number of elements in each
+    folder, indexed by node.idx.
+    """
+    if isinstance(row_tree,compact_tree.CompactTree):
+        return row_tree.sizes
+    cache = _tree_cache(row_tree)
+    if "sizes" not in cache:
+        cache["sizes"] = np.array([x.size for x in row_tree])
+    return cache["sizes"]
+
+def node_parents(row_tree):
+    """
+    Returns an array (size tree_size) with the node.idx of the parent of each
+    folder (-1 for the root), indexed by node.idx.
+    """
+    if isinstance(row_tree,compact_tree.CompactTree):
+        return row_tree.parents
+    cache = _tree_cache(row_tree)
+    if "parents" not in cache:
+        cache["parents"] = np.array([-1 if x.parent is None else x.parent.idx
+                                     for x in row_tree])
+    return cache["parents"]
+
+def folder_indicator(row_tree):
+    """
+    Returns the folder membership operator of row_tree: a scipy.sparse CSR 
+    matrix of size (tree_size x n) with a 1 in (node.idx,j) if j is one of 
+    node.elements. Built once per tree and cached.
+    """
+    cache = _tree_cache(row_tree)
+    if "indicator" not in cache:
+        sizes = node_sizes(row_tree)
+        if isinstance(row_tree,compact_tree.CompactTree):
+            #folder i is order[offsets[i]:offsets[i]+sizes[i]]
+            starts = np.cumsum(sizes) - sizes
+            positions = (np.arange(np.sum(sizes)) + 
+                         np.repeat(row_tree.offsets - starts,sizes))
+            indices = row_tree.order[positions]
+        else:
+            indices = np.concatenate([np.asarray(x.elements,np.int64) 
+                                      for x in row_tree])
+        indptr = np.concatenate([[0],np.cumsum(sizes)])
+        cache["indicator"] = sps.csr_matrix((np.ones(len(indices)),
+                                             indices,indptr),
+                                            shape=(row_tree.tree_size,
+                                                   row_tree.size))
+    return cache["indicator"]
+
+def tree_fingerprint(row_tree):
+    """
+    Returns a hex digest identifying the structure of row_tree: the parent 
+    and child order of every node and the elements of every leaf. Two trees
+    with the same fingerprint have the same node.idx numbering, folders and
+    child order, so anything derived from one can be reused for the other.
+    Cached on the tree.
+    """
+    cache = _tree_cache(row_tree)
+    if "fingerprint" not in cache:
+        if isinstance(row_tree,compact_tree.CompactTree):
+            children = row_tree.child_idx
+            leaves = np.flatnonzero(row_tree.n_children == 0)
+            leaf_elements = np.concatenate([np.sort(
+                row_tree.order[row_tree.offsets[x]:
+                               row_tree.offsets[x]+row_tree.sizes[x]])
+                                            for x in leaves])
+        else:
+            children = [y.idx for x in row_tree for y in x.children]
+            leaves = [x.idx for x in row_tree if len(x.children) == 0]
+            leaf_elements = [y for x in leaves for y in row_tree[x].elements]
+        sha = hashlib.sha1()
+        for arr in [node_parents(row_tree),children,leaves,leaf_elements]:
+            sha.update(np.asarray(arr,np.int64).tostring())
+            sha.update(b"|")
+        cache["fingerprint"] = sha.hexdigest()
+    return cache["fingerprint"]
+
+def _apply_rows(operator,data):
+    """
+    Applies a sparse operator to the rows of dense or sparse data of any 
+    number of dimensions, returning a dense array.
+    """
+    if sps.issparse(data):
+        return operator.dot(data).toarray()
+    data = np.asarray(data)
+    flat = operator.dot(data.reshape(data.shape[0],-1))
+    return flat.reshape((operator.shape[0],)+data.shape[1:])
+
 def tree_sums(data,row_tree):
     """
-    data is a vector or matrix of size d or (dxm) 
+    data is a vector or matrix of size d or (dxm) (dense or scipy.sparse)
     row_tree is a tree on the rows. tree_size is n. 
     Returns a vector (size n) or a matrix (size nxm) containing sums on folders.
     """
-    
-    if data.ndim == 1:
-        sums = np.zeros([row_tree.tree_size])
-        for node in row_tree.traverse():
-            sums[node.idx] = np.sum(data[node.elements])
-    else:
-        sums = np.zeros([row_tree.tree_size]+list(np.shape(data)[1:]))
-        for node in row_tree.traverse():
-            sums[node.idx,...] = np.sum(data[node.elements,:],axis=0)
-    
-    return sums
+    return _apply_rows(folder_indicator(row_tree),data)
     
 def tree_averages(data,row_tree):
     """
-    data is a vector or matrix of size d or (dxm) 
+    data is a vector or matrix of size d or (dxm) (dense or scipy.sparse)
     row_tree is a tree on the rows. tree_size is n. 
     Returns a vector (size n) or a matrix (size nxm) containing avgs on folders.
     """
     averages = tree_sums(data,row_tree)
-    if data.ndim == 1:
-        for node in row_tree.traverse():
-            averages[node.idx] /= node.size
-    else:
-        for node in row_tree.traverse():
-            averages[node.idx,:] /= node.size
-    
+    sizes = node_sizes(row_tree)
+    averages /= sizes.reshape((-1,)+(1,)*(averages.ndim-1))
     return averages
 
 def tree_transform(data,row_tree):
     """
-    data is a vector or matrix of size d or (dxm) 
+    data is a vector or matrix of size d or (dxm) (dense or scipy.sparse)
     row_tree is a tree on the rows. tree_size is n. 
     Returns a vector (size n) or a matrix (size nxm) containing coefs.
     """
     avs = tree_averages(data,row_tree)
-    coefs = np.zeros(np.shape(avs))
-    if avs.ndim == 1:
-        for node in row_tree:
-            if node.parent is None:
-                coefs[node.idx] = avs[node.idx]
-            else:
-                coefs[node.idx] = avs[node.idx] - avs[node.parent.idx]
-    else:
-        for node in row_tree:
-            if node.parent is None:
-                coefs[node.idx,:] = avs[node.idx,:]
-            else:
-                coefs[node.idx,:] = avs[node.idx,:] - avs[node.parent.idx,:]
+    parents = node_parents(row_tree)
+    nonroot = parents >= 0
+    coefs = avs.copy()
+    coefs[nonroot,...] -= avs[parents[nonroot],...]
     return coefs
 
 
@@ -174,18 +406,11 @@ def inverse_tree_transform(coefs,row_tree,threshold=0.0):
     on folders whose fraction of the total data matrix < threshold.
     """
     n = row_tree.size
-    if coefs.ndim == 1:
-        mat = np.zeros([row_tree.size],np.float)
-        for node in row_tree:
-            if node.size*1.0/n >= threshold:
-                mat[node.elements] += coefs[node.idx]
-    else:
-        mat = np.zeros([row_tree.size,np.shape(coefs)[1]])
-        for node in row_tree:
-            if node.size*1.0/n >= threshold:
-                mat[node.elements,:] += coefs[node.idx,:]
-    
-    return mat
+    keep = 1.0*node_sizes(row_tree)/n >= threshold
+    if sps.issparse(coefs):
+        coefs = coefs.toarray()
+    coefs = coefs*keep.reshape((-1,)+(1,)*(coefs.ndim-1))
+    return _apply_rows(folder_indicator(row_tree).T,coefs)
 
 def normalize_tree_coefs(coefs,row_tree):
     """